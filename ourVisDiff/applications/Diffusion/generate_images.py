@@ -1,6 +1,9 @@
 # from torch import autocast
 import argparse
+import json
 import os
+import queue
+import threading
 
 import pandas as pd
 import torch
@@ -8,6 +11,119 @@ from diffusers import EulerDiscreteScheduler, StableDiffusionPipeline
 
 import wandb
 
+from prompt_cache import PromptEmbeddingCache
+
+
+def get_prompt_dir(prompt: str) -> str:
+    # same naming as generate_csv.process_parti
+    return prompt.replace(" ", "_").replace(".", "")[:100]
+
+
+def load_manifest(manifest_file: str) -> set:
+    """
+    (prompt, model_id) pairs whose images are all on disk. A line cut off by an
+    interruption is ignored and that prompt generated again.
+    """
+    done = set()
+    if not os.path.exists(manifest_file):
+        return done
+    with open(manifest_file, "r") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done.add((item["prompt"], item["model_id"], item["n"]))
+    return done
+
+
+class ImageWriter:
+    """
+    Save generated images on a background thread, so the GPU can start the next
+    batch right away. Once all n images of a prompt are saved, the prompt is
+    added to the manifest and logged to wandb.
+    """
+
+    def __init__(self, save_dir: str, manifest_file: str, n: int):
+        self.save_dir = save_dir
+        self.manifest_file = manifest_file
+        self.n = n
+        self.queue = queue.Queue(maxsize=4 * n)
+        self.saved = {}  # (prompt, model_id) -> images saved so far
+        self.logged = {}  # (prompt, model_id) -> images to log to wandb
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, prompt: str, model_id: str, s: int, image):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((prompt, model_id, s, image))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.save(*item)
+            except Exception as e:
+                self.error = e
+
+    def save(self, prompt: str, model_id: str, s: int, image):
+        save_dir = f"{self.save_dir}/{get_prompt_dir(prompt)}/{model_id}"
+        os.makedirs(save_dir, exist_ok=True)
+        image.save(f"{save_dir}/{s}.png")
+
+        key = (prompt, model_id)
+        self.saved[key] = self.saved.get(key, 0) + 1
+        if s < min([20, self.n]):
+            self.logged.setdefault(key, []).append(image)
+        if self.saved[key] < self.n:
+            return
+
+        with open(self.manifest_file, "a") as f:
+            f.write(json.dumps({"prompt": prompt, "model_id": model_id, "n": self.n}))
+            f.write("\n")
+        wandb.log(
+            {f"{model_id}-{prompt}": [wandb.Image(i) for i in self.logged.pop(key)]}
+        )
+        del self.saved[key]
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def generate(pipe, model_id, prompts, negative_prompt, latents, writer, args):
+    """
+    Generate args.n images for every prompt. The (prompt, image) pairs of all
+    prompts are packed into denoising batches of args.batch_size images, and
+    image s of every prompt starts from latents[s]. Prompt embeddings come from
+    the on-disk cache of the pipeline's text encoder.
+    """
+    prompt_cache = PromptEmbeddingCache(pipe, args.prompt_cache_dir)
+    negative_embeds = prompt_cache.encode([negative_prompt]).to(pipe.device)
+    items = [(prompt, s) for prompt in prompts for s in range(args.n)]
+    for start in range(0, len(items), args.batch_size):
+        batch = items[start : start + args.batch_size]
+        batch_prompts = [prompt for prompt, _ in batch]
+        print(f"Generating images for prompts: {list(dict.fromkeys(batch_prompts))}")
+        # only the embeddings of the current batch live on the device
+        prompt_embeds = prompt_cache.encode(batch_prompts).to(pipe.device)
+        with torch.autocast("cuda"):
+            images = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds.expand(len(batch), -1, -1),
+                guidance_scale=7.5,
+                latents=latents[[s for _, s in batch]],
+            ).images
+
+        for (prompt, s), image in zip(batch, images):
+            writer.put(prompt, model_id, s, image)
+
 
 def main(args):
     if args.wandb_silent:
@@ -31,61 +147,47 @@ def main(args):
     negative_prompt = ", ".join(negative_prompts)
     print(f"Negative Prompt: {negative_prompt}")
 
-    for model_id in args.model_id:
-        # Use the Euler scheduler here instead
-        scheduler = EulerDiscreteScheduler.from_pretrained(
-            model_id, subfolder="scheduler"
+    if args.prompts == ["PartiPrompts"]:
+        parti_prompts = pd.read_csv(
+            "applications/Diffusion/generation/parti-prompts.csv"
         )
-        pipe = StableDiffusionPipeline.from_pretrained(
-            model_id,
-            scheduler=scheduler,
-            torch_dtype=torch.float16,
-            requires_safety_checker=False,
-            safety_checker=None,
-        )
-        pipe = pipe.to("cuda")
-        if args.prompts == ["PartiPrompts"]:
-            parti_prompts = pd.read_csv(
-                "applications/Diffusion/generation/parti-prompts.csv"
-            )
-            prompts = parti_prompts["Prompt"].tolist()
-        elif args.prompts == ["DiffusionDB"]:
-            with open("applications/Diffusion/generation/diffusiondb.txt", "r") as f:
-                prompts = [line.replace("\n", "") for line in f.readlines()]
-        else:
-            prompts = args.prompts
-        for p, prompt in enumerate(prompts):
-            if os.path.exists(
-                f'{args.save_dir}/{prompt.replace(" ", "_").replace(".", "")}/{model_id}'
-            ):
+        prompts = parti_prompts["Prompt"].tolist()
+    elif args.prompts == ["DiffusionDB"]:
+        with open("applications/Diffusion/generation/diffusiondb.txt", "r") as f:
+            prompts = [line.replace("\n", "") for line in f.readlines()]
+    else:
+        prompts = args.prompts
+    prompts = list(dict.fromkeys(prompts))
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    manifest_file = f"{args.save_dir}/manifest.jsonl"
+    done = load_manifest(manifest_file)
+    writer = ImageWriter(args.save_dir, manifest_file, args.n)
+
+    try:
+        for model_id in args.model_id:
+            todo = [p for p in prompts if (p, model_id, args.n) not in done]
+            print(f"{model_id}: {len(prompts) - len(todo)} prompts already done")
+            if len(todo) == 0:
                 continue
-            print(f"Generating images for prompt: {prompt}")
-            with torch.autocast("cuda"):
-                # split up into batches of 5
-                images = []
-                step = min([5, args.n])
-                for i in range(0, args.n, step):
-                    images += pipe(
-                        prompt,
-                        negative_prompt=negative_prompt,
-                        num_images_per_prompt=step,
-                        guidance_scale=7.5,
-                        latents=latents[i : i + step],
-                    ).images
-
-            for s, i in enumerate(images):
-                save_dir = f'{args.save_dir}/{prompt.replace(" ", "_").replace(".", "")[:100]}/{model_id}'
-                if not os.path.exists(save_dir):
-                    os.makedirs(save_dir)
-                i.save(f"{save_dir}/{s}.png")
-
-            wandb.log(
-                {
-                    f"{model_id}-{prompt}": [
-                        wandb.Image(i) for i in images[: min([20, args.n])]
-                    ]
-                }
+
+            # Use the Euler scheduler here instead
+            scheduler = EulerDiscreteScheduler.from_pretrained(
+                model_id, subfolder="scheduler"
+            )
+            pipe = StableDiffusionPipeline.from_pretrained(
+                model_id,
+                scheduler=scheduler,
+                torch_dtype=torch.float16,
+                requires_safety_checker=False,
+                safety_checker=None,
             )
+            pipe = pipe.to("cuda")
+            generate(pipe, model_id, todo, negative_prompt, latents, writer, args)
+            del pipe
+            torch.cuda.empty_cache()
+    finally:
+        writer.close()
 
 
 if __name__ == "__main__":
@@ -101,11 +203,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "--n", type=int, default=50, help="number of images to generate"
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="images per denoising batch, across prompts",
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        type=str,
+        default="cache/prompt_embeds",
+        help="directory of cached prompt embeddings",
+    )
     parser.add_argument("--wandb-silent", action="store_true")
     parser.add_argument(
         "--model-id",
         type=str,
-        default="CompVis/stable-diffusion-v1-4",
+        default=["CompVis/stable-diffusion-v1-4"],
         nargs="+",
         help="huggingface model id",
     )
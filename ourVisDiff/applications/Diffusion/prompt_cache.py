@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+
+def get_text_encoder_fingerprint(pipe) -> str:
+    """
+    Hash of the tokenizer and the text encoder weights of a pipeline. Models
+    that ship the same text encoder get the same fingerprint and share cached
+    embeddings.
+    """
+    h = hashlib.sha256()
+    h.update(pipe.text_encoder.config.to_json_string(use_diff=False).encode())
+    h.update(json.dumps(sorted(pipe.tokenizer.get_vocab().items())).encode())
+    h.update(str(pipe.tokenizer.model_max_length).encode())
+    for name, tensor in sorted(pipe.text_encoder.state_dict().items()):
+        h.update(name.encode())
+        data = tensor.detach().cpu().contiguous().reshape(-1)
+        h.update(data.view(torch.uint8).numpy())
+    return h.hexdigest()[:16]
+
+
+class PromptEmbeddingCache:
+    """
+    Text-encoder outputs of prompts, computed once per (text encoder, prompt)
+    and stored under cache_dir/<fingerprint>/ as one tensor file per prompt.
+    The most recently used memory_size embeddings are also kept in host memory.
+    encode returns CPU tensors; move them to the pipeline's device and pass them
+    as prompt_embeds or negative_prompt_embeds.
+    """
+
+    def __init__(
+        self, pipe, cache_dir: str = "cache/prompt_embeds", memory_size: int = 256
+    ):
+        self.pipe = pipe
+        self.fingerprint = get_text_encoder_fingerprint(pipe)
+        self.cache_dir = f"{cache_dir}/{self.fingerprint}"
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.memory_size = memory_size
+        self.embeds = OrderedDict()  # prompt -> CPU embedding, least recent first
+
+    def get_file(self, prompt: str) -> str:
+        return f"{self.cache_dir}/{hashlib.sha256(prompt.encode()).hexdigest()}.pt"
+
+    def load(self, prompt: str) -> Optional[torch.Tensor]:
+        if prompt in self.embeds:
+            self.embeds.move_to_end(prompt)
+            return self.embeds[prompt]
+        if os.path.exists(self.get_file(prompt)):
+            self.embeds[prompt] = torch.load(self.get_file(prompt), map_location="cpu")
+            return self.embeds[prompt]
+        return None
+
+    def save(self, prompt: str, embeds: torch.Tensor):
+        embeds = embeds.cpu().clone()
+        self.embeds[prompt] = embeds
+        file = self.get_file(prompt)
+        torch.save(embeds, file + ".tmp")
+        os.replace(file + ".tmp", file)
+
+    def encode(self, prompts: List[str]) -> torch.Tensor:
+        """
+        (len(prompts) x tokens x dim) embeddings of prompts, on the CPU. Prompts
+        that are not cached yet are encoded together in one text-encoder call.
+        """
+        found = {p: self.load(p) for p in dict.fromkeys(prompts)}
+        missing = [p for p, embeds in found.items() if embeds is None]
+        if missing:
+            with torch.inference_mode():
+                embeds, _ = self.pipe.encode_prompt(
+                    missing, self.pipe.device, 1, do_classifier_free_guidance=False
+                )
+            for prompt, embed in zip(missing, embeds):
+                self.save(prompt, embed)
+                found[prompt] = self.embeds[prompt]
+        while len(self.embeds) > self.memory_size:
+            self.embeds.popitem(last=False)
+        return torch.stack([found[p] for p in prompts])
@@ -3,11 +3,9 @@ from typing import Dict, List
 
 import pandas as pd
 from model import ModelFactory
-from PIL import Image
-from tqdm import tqdm
 
 
-def get_model_outputs():
+def get_model_outputs(batch_size: int = 128):
     model1 = ModelFactory.get_model("clip_vitb32_zeroshot")
     model2 = ModelFactory.get_model("resnet50_supervised")
 
@@ -27,14 +25,14 @@ def get_model_outputs():
     image_paths = [item["path"] for item in dataset]
 
     label = dataset[0]["imagenet_label"].replace("_", " ")
-    predictions1 = [model1.get_prediction(image) for image in tqdm(image_paths)]
-    predictions2 = [model2.get_prediction(image) for image in tqdm(image_paths)]
-
-    for item in dataset:
-        item["imagenet_prediction_(clip_vitb32_zeroshot)"] = predictions1.pop(
-            0
-        ).replace(" ", "_")
-        item["imagenet_prediction_(resnet50_supervised)"] = predictions2.pop(0).replace(
+    predictions1 = model1.get_predictions(image_paths, batch_size=batch_size)
+    predictions2 = model2.get_predictions(image_paths, batch_size=batch_size)
+
+    for item, prediction1, prediction2 in zip(dataset, predictions1, predictions2):
+        item["imagenet_prediction_(clip_vitb32_zeroshot)"] = prediction1.replace(
+            " ", "_"
+        )
+        item["imagenet_prediction_(resnet50_supervised)"] = prediction2.replace(
             " ", "_"
         )
 
@@ -1,15 +1,19 @@
 import io
 import json
 import os
+import sys
 from abc import ABC, abstractmethod
+from typing import List, Tuple
 
 import clip
+import numpy as np
 import requests
 import torch
-import torch.nn.functional as F
-from PIL import Image
 from torchvision import models, transforms
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from zero_shot import ZeroShotClassifier, get_image_loader
+
 # Fetch ImageNet class names
 IMAGENET_CLASSES_URL = "https://storage.googleapis.com/download.tensorflow.org/data/imagenet_class_index.json"
 if not os.path.exists("imagenet_class_index.json"):
@@ -26,46 +30,57 @@ class BaseModel(ABC):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     @abstractmethod
-    def get_prediction(self, image: str) -> str:
+    def get_logits(self, images: List[str], batch_size: int = 128) -> torch.Tensor:
+        """
+        (N x len(IDX_TO_LABEL)) class logits of images, on the CPU.
+        """
         pass
 
+    def get_topk_predictions(
+        self, images: List[str], k: int = 5, batch_size: int = 128
+    ) -> Tuple[List[List[str]], np.ndarray]:
+        """
+        The k most likely labels of every image and their (N x k) logits.
+        """
+        logits, indices = self.get_logits(images, batch_size).topk(k, dim=1)
+        labels = [[IDX_TO_LABEL[i] for i in row] for row in indices.tolist()]
+        return labels, logits.numpy()
+
+    def get_predictions(self, images: List[str], batch_size: int = 128) -> List[str]:
+        indices = self.get_logits(images, batch_size).argmax(dim=1)
+        return [IDX_TO_LABEL[i] for i in indices.tolist()]
+
+    def get_prediction(self, image: str) -> str:
+        return self.get_predictions([image])[0]
+
 
 class CLIPModel(BaseModel):
     def __init__(self):
         super().__init__()
         self.model, self.transform = self._load_model()
         self.model.eval()
-        text_inputs = torch.cat(
-            [clip.tokenize(f"a photo of a {c}") for c in IDX_TO_LABEL]
+        # Encode the list of ImageNet class names once
+        self.classifier = ZeroShotClassifier(
+            self.model,
+            self.transform,
+            [f"a photo of a {c}" for c in IDX_TO_LABEL],
+            self.device,
         )
-        with torch.no_grad():
-            self.text_features = self.model.encode_text(text_inputs.to(self.device))
-            self.text_features = F.normalize(self.text_features, p=2, dim=1)
+        self.text_features = self.classifier.text_features
 
     def _load_model(self):
-        return clip.load("ViT-B/32")
-
-    def get_prediction(self, image: str) -> str:
-        pil_image = Image.open(image).convert("RGB")
-        tensor_image = self.transform(pil_image).unsqueeze(0).to(self.device)
+        return clip.load("ViT-B/32", device=self.device)
 
-        # Encode the list of ImageNet class names
-
-        with torch.no_grad():
-            image_features = self.model.encode_image(tensor_image)
-            image_features = F.normalize(image_features, p=2, dim=1)
-
-            # Find the top 1 most similar label for the image
-            similarity = (100.0 * image_features @ self.text_features.T).softmax(dim=-1)
-            _, indices = similarity[0].topk(1)
-
-            return IDX_TO_LABEL[indices[0].item()]
+    def get_logits(self, images: List[str], batch_size: int = 128) -> torch.Tensor:
+        self.classifier.batch_size = batch_size
+        return 100.0 * self.classifier.get_similarities(images).cpu()
 
 
 class ResNet50Model(BaseModel):
-    def __init__(self):
+    def __init__(self, num_workers: int = 8):
         super().__init__()
         self.model = self._load_model()
+        self.num_workers = num_workers
         self.transform = transforms.Compose(
             [
                 transforms.Resize(224),
@@ -82,15 +97,18 @@ class ResNet50Model(BaseModel):
         model.eval().to(self.device)
         return model
 
-    def get_prediction(self, image: str) -> str:
-        pil_image = Image.open(image).convert("RGB")
-        tensor_image = self.transform(pil_image).unsqueeze(0).to(self.device)
-
-        with torch.no_grad():
-            outputs = self.model(tensor_image)
-            _, predicted = outputs.max(1)
-
-            return IDX_TO_LABEL[predicted.item()]
+    def get_logits(self, images: List[str], batch_size: int = 128) -> torch.Tensor:
+        loader = get_image_loader(
+            images, self.transform, batch_size, self.num_workers, self.device
+        )
+        logits = torch.empty((len(images), len(IDX_TO_LABEL)))
+        start = 0
+        with torch.inference_mode():
+            for batch in loader:
+                batch = batch.to(self.device, non_blocking=True)
+                logits[start : start + len(batch)] = self.model(batch).float().cpu()
+                start += len(batch)
+        return logits
 
 
 class ModelFactory:
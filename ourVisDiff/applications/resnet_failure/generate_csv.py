@@ -1,7 +1,10 @@
 import argparse
+import hashlib
+import json
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 import torch
 import torchvision
@@ -51,16 +54,73 @@ def process_imagenet_v2(imagenet_root, imagenet_v2_root, save_dir="./data"):
     return df
 
 
-def get_resnet_preds(df, batch_size=128):
+class ImagePathDataset(torch.utils.data.Dataset):
+    def __init__(self, paths, transform):
+        self.paths = paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return i, self.transform(Image.open(self.paths[i]).convert("RGB"))
+
+
+def open_pred_columns(names, paths, save_dir=None):
+    """
+    One int64 prediction column per model, -1 marking rows not predicted yet.
+    With save_dir, the columns are .npy memmaps that survive an interruption and
+    are reused if they were written for the same list of paths.
+    """
+    if save_dir is None:
+        return {name: np.full(len(paths), -1, dtype=np.int64) for name in names}
+
+    os.makedirs(save_dir, exist_ok=True)
+    paths_hash = hashlib.sha256("\n".join(paths).encode()).hexdigest()
+    meta_file = f"{save_dir}/meta.json"
+    resume = False
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            resume = json.load(f)["paths_hash"] == paths_hash
+    if not resume and os.path.exists(meta_file):
+        # the columns are about to be reset, so no run may trust them meanwhile
+        os.remove(meta_file)
+
+    columns = {}
+    for name in names:
+        column_file = f"{save_dir}/{name}.npy"
+        if resume and os.path.exists(column_file):
+            columns[name] = np.load(column_file, mmap_mode="r+")
+        else:
+            columns[name] = np.lib.format.open_memmap(
+                column_file, mode="w+", dtype=np.int64, shape=(len(paths),)
+            )
+            columns[name][:] = -1
+            columns[name].flush()
+
+    # written last, once the columns match paths
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump({"paths_hash": paths_hash, "n": len(paths)}, f)
+    os.replace(meta_file + ".tmp", meta_file)
+    return columns
+
+
+def get_resnet_preds(df, batch_size=128, num_workers=8, save_dir=None):
+    """
+    Top-1 ImageNet predictions of ResNet50 and ResNet101, with one forward pass
+    per model per batch. Images are decoded by DataLoader workers while the GPU
+    runs. Rows that already have predictions in save_dir are skipped.
+    """
     print(f"Getting ResNet50 and ResNet101 predictions")
     # get resnet50 pretrained on imagenet
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    resnet50 = torchvision.models.resnet50(pretrained=True)
-    resnet50.eval()
-    resnet50.to(device)
-    resnet101 = torchvision.models.resnet101(pretrained=True)
-    resnet101.eval()
-    resnet101.to(device)
+    models = {
+        "resnet50_preds": torchvision.models.resnet50(pretrained=True),
+        "resnet101_preds": torchvision.models.resnet101(pretrained=True),
+    }
+    for model in models.values():
+        model.eval()
+        model.to(device)
     transform = transforms.Compose(
         [
             transforms.Resize((224, 224)),
@@ -68,35 +128,38 @@ def get_resnet_preds(df, batch_size=128):
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
         ]
     )
+    paths = df["path"].tolist()
+    preds = open_pred_columns(list(models.keys()), paths, save_dir)
+    todo = np.flatnonzero(
+        np.any(np.stack([column < 0 for column in preds.values()]), axis=0)
+    )
+    print(f"{len(paths) - len(todo)} images already predicted, {len(todo)} to go")
+
     # get predictions
-    preds = {"resnet50_preds": [], "resnet101_preds": [], "ensemble_preds": []}
-    for i in tqdm(range(0, len(df), batch_size)):
-        batch = df.iloc[i : i + batch_size]
-        targets = torch.tensor(batch["class_num"].values).to(device)
-        images = torch.stack(
-            [transform(Image.open(path).convert("RGB")) for path in batch["path"]]
-        ).to(device)
-        with torch.no_grad():
-            preds["resnet50_preds"] += (
-                resnet101(images).cpu().numpy().argmax(axis=1).tolist()
-            )
-            preds["resnet101_preds"] += (
-                resnet101(images).cpu().numpy().argmax(axis=1).tolist()
-            )
-            resnet50_correct = (
-                resnet101(images).cpu().numpy().argmax(axis=1) == targets.cpu().numpy()
-            )
-            resnet101_correct = (
-                resnet101(images).cpu().numpy().argmax(axis=1) == targets.cpu().numpy()
-            )
-            ensamble_correct = resnet50_correct | resnet101_correct
-            preds["ensemble_preds"] += ensamble_correct.tolist()
-            print(
-                len(preds["resnet50_preds"]),
-                len(preds["resnet101_preds"]),
-                len(preds["ensemble_preds"]),
-            )
-    return preds
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(ImagePathDataset(paths, transform), todo.tolist()),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=device.type == "cuda",
+    )
+    with torch.inference_mode():
+        for indices, images in tqdm(loader):
+            images = images.to(device, non_blocking=True)
+            indices = indices.numpy()
+            for name, model in models.items():
+                preds[name][indices] = model(images).argmax(dim=1).cpu().numpy()
+            if save_dir is not None:
+                for column in preds.values():
+                    column.flush()
+
+    targets = df["class_num"].to_numpy()
+    resnet50_correct = preds["resnet50_preds"] == targets
+    resnet101_correct = preds["resnet101_preds"] == targets
+    return {
+        "resnet50_preds": np.asarray(preds["resnet50_preds"]),
+        "resnet101_preds": np.asarray(preds["resnet101_preds"]),
+        "ensemble_preds": resnet50_correct | resnet101_correct,
+    }
 
 
 if __name__ == "__main__":
@@ -105,9 +168,11 @@ if __name__ == "__main__":
 
     # call function by add process_ to the dataset name
     df = process_imagenet_v2(IMAGENET_PATH, IMAGENETV2_PATH, CSV_SAVE_DIR)
-    preds = get_resnet_preds(df)
+    df = df.reset_index(drop=True)
+    preds = get_resnet_preds(df, save_dir=f"{CSV_SAVE_DIR}/imagenetV2_preds")
 
-    df = pd.concat([df, pd.DataFrame(preds)], axis=1)
+    for name, column in preds.items():
+        df[name] = column
 
     df["group_name"] = df["ensemble_preds"].apply(
         lambda x: "correct" if x else "incorrect"
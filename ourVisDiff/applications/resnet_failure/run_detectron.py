@@ -1,14 +1,62 @@
+import argparse
+import json
 import os
 
 import pandas as pd
-import requests
 import torch
 from PIL import Image
 from tqdm import tqdm
 from transformers import DetrForObjectDetection, DetrImageProcessor
 
-if __name__ == "__main__":
-    df = pd.read_csv("./data/imagenetV2.csv")
+PERSON_LABEL = 1  # COCO id of "person"
+
+
+class DetrBatchCollator:
+    """
+    Decode a batch of images and pad them into one DETR input. Runs in the
+    DataLoader workers, so preprocessing overlaps with detection.
+    """
+
+    def __init__(self, paths, processor):
+        self.paths = paths
+        self.processor = processor
+
+    def __call__(self, indices):
+        images = [Image.open(self.paths[i]).convert("RGB") for i in indices]
+        inputs = self.processor(images=images, return_tensors="pt")
+        target_sizes = torch.tensor([image.size[::-1] for image in images])
+        return indices, inputs, target_sizes
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    Detections already written to checkpoint_file, keyed by path. A line cut
+    off by an interruption is ignored and its image detected again.
+    """
+    done = {}
+    if not os.path.exists(checkpoint_file):
+        return done
+    with open(checkpoint_file) as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[item["path"]] = item
+    return done
+
+
+def detect_people(
+    paths,
+    checkpoint_file,
+    batch_size=16,
+    num_workers=4,
+    threshold=0.9,
+):
+    """
+    Run DETR over paths in padded batches and append the detections of every
+    batch to checkpoint_file, skipping paths that are already in it.
+    """
     # you can specify the revision tag if you don't want the timm dependency
     processor = DetrImageProcessor.from_pretrained(
         "facebook/detr-resnet-50", revision="no_timm"
@@ -16,25 +64,70 @@ if __name__ == "__main__":
     model = DetrForObjectDetection.from_pretrained(
         "facebook/detr-resnet-50", revision="no_timm"
     )
-    people_detected = {"path": [], "person": [], "labels": []}
-
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        image = Image.open(row["path"]).convert("RGB")
-        inputs = processor(images=image, return_tensors="pt")
-        outputs = model(**inputs)
-
-        # convert outputs (bounding boxes and class logits) to COCO API
-        # let's only keep detections with score > 0.9
-        target_sizes = torch.tensor([image.size[::-1]])
-        results = processor.post_process_object_detection(
-            outputs, target_sizes=target_sizes, threshold=0.9
-        )[0]
-        people_detected["path"].append(row["path"])
-        people_detected["person"].append(
-            any([x == 1 for x in results["labels"].numpy()])
-        )
-        people_detected["labels"].append(
-            str([model.config.id2label[label.item()] for label in results["labels"]])
-        )
-    people_detected = pd.DataFrame(people_detected)
-    df.merge(people_detected, on="path").to_csv("people_detected.csv", index=False)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.eval().to(device)
+
+    done = load_checkpoint(checkpoint_file)
+    todo = [i for i, path in enumerate(paths) if path not in done]
+    print(f"{len(paths) - len(todo)} images already detected, {len(todo)} to go")
+
+    loader = torch.utils.data.DataLoader(
+        todo,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=DetrBatchCollator(paths, processor),
+    )
+    with open(checkpoint_file, "a") as f, torch.inference_mode():
+        for indices, inputs, target_sizes in tqdm(loader):
+            inputs = {key: value.to(device) for key, value in inputs.items()}
+            outputs = model(**inputs)
+
+            # convert outputs (bounding boxes and class logits) to COCO API
+            # let's only keep detections with score > threshold
+            results = processor.post_process_object_detection(
+                outputs, target_sizes=target_sizes.to(device), threshold=threshold
+            )
+            for i, result in zip(indices, results):
+                labels = result["labels"].tolist()
+                item = {
+                    "path": paths[i],
+                    "person": PERSON_LABEL in labels,
+                    "labels": str([model.config.id2label[label] for label in labels]),
+                }
+                f.write(json.dumps(item) + "\n")
+                done[item["path"]] = item
+            f.flush()
+            os.fsync(f.fileno())
+
+    return pd.DataFrame([done[path] for path in dict.fromkeys(paths)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", type=str, default="./data/imagenetV2.csv")
+    parser.add_argument("--output", type=str, default="people_detected.csv")
+    parser.add_argument(
+        "--checkpoint", type=str, default="people_detected.jsonl", help="resume file"
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--threads", type=int, help="intra-op threads for torch")
+    parser.add_argument("--interop-threads", type=int, help="inter-op threads")
+    args = parser.parse_args()
+
+    # must be set before torch runs any parallel work
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads:
+        torch.set_num_interop_threads(args.interop_threads)
+
+    df = pd.read_csv(args.csv)
+    people_detected = detect_people(
+        df["path"].tolist(),
+        args.checkpoint,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        threshold=args.threshold,
+    )
+    df.merge(people_detected, on="path").to_csv(args.output, index=False)
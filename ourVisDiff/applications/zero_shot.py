@@ -0,0 +1,94 @@
+from typing import List
+
+import clip
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+
+class ImagePathDataset(Dataset):
+    def __init__(self, paths: List[str], preprocess):
+        self.paths = paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.preprocess(Image.open(self.paths[i]).convert("RGB"))
+
+
+def get_image_loader(
+    paths: List[str], preprocess, batch_size: int, num_workers: int, device
+) -> DataLoader:
+    """
+    Batches of preprocessed images in the order of paths. Decoding runs in
+    worker processes and overlaps with inference on the previous batch.
+    """
+    return DataLoader(
+        ImagePathDataset(paths, preprocess),
+        batch_size=batch_size,
+        num_workers=num_workers if len(paths) > batch_size else 0,
+        pin_memory=torch.device(device).type == "cuda",
+    )
+
+
+class ZeroShotClassifier:
+    """
+    CLIP zero-shot classification against a fixed list of prompts. The prompts
+    are encoded once, images are decoded by DataLoader workers and encoded in
+    batches, and the prompt scores of all images come from one matrix product.
+    """
+
+    def __init__(
+        self,
+        model,
+        preprocess,
+        prompts: List[str],
+        device,
+        batch_size: int = 128,
+        num_workers: int = 8,
+    ):
+        self.model = model
+        self.preprocess = preprocess
+        self.prompts = prompts
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        with torch.inference_mode():
+            text_features = model.encode_text(clip.tokenize(prompts).to(self.device))
+            self.text_features = F.normalize(text_features.float(), p=2, dim=1)
+
+    def encode_images(self, paths: List[str]) -> torch.Tensor:
+        """
+        Normalized (N x D) image features, in the order of paths.
+        """
+        loader = get_image_loader(
+            paths, self.preprocess, self.batch_size, self.num_workers, self.device
+        )
+        image_features = torch.empty(
+            (len(paths), self.text_features.shape[1]), device=self.device
+        )
+        start = 0
+        with torch.inference_mode():
+            for images in loader:
+                images = images.to(self.device, non_blocking=True)
+                features = self.model.encode_image(images).float()
+                image_features[start : start + len(images)] = F.normalize(
+                    features, p=2, dim=1
+                )
+                start += len(images)
+        return image_features
+
+    def get_similarities(self, paths: List[str]) -> torch.Tensor:
+        # (N x P) cosine similarities
+        return self.encode_images(paths) @ self.text_features.T
+
+    def classify(self, paths: List[str], topk: int = 1) -> np.ndarray:
+        """
+        (N x topk) indices into prompts of the most similar prompts per image.
+        """
+        similarities = self.get_similarities(paths)
+        return similarities.topk(topk, dim=1).indices.cpu().numpy()
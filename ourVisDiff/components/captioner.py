@@ -11,7 +11,7 @@ import components.prompts as prompts
 import wandb
 from serve.utils_general import save_data_diff_image
 from serve.utils_llm import get_llm_output
-from serve.utils_vlm import get_embed_caption_blip, get_vlm_output
+from serve.utils_vlm import get_embed_caption_blip, get_vlm_outputs
 
 
 class Captioner:
@@ -25,7 +25,7 @@ class Captioner:
         Given two datasets, return a list of hypotheses
         """
         all_captions = []
-        random.seed(self.args["seed"])
+        self.rng = random.Random(self.args["seed"])
         for i in range(self.args["num_rounds"]):
             sampled_dataset1 = self.sample(dataset1, self.args["num_samples"])
             captions = self.get_captions(sampled_dataset1)
@@ -33,7 +33,7 @@ class Captioner:
         return all_captions
 
     def sample(self, dataset: List[Dict], n: int) -> List[Dict]:
-        return random.sample(dataset, n)
+        return self.rng.sample(dataset, n)
 
     def visualize(
         self, sampled_dataset1: List[Dict], sampled_dataset2: List[Dict]
@@ -56,12 +56,13 @@ class Captioner:
         return images
 
     def captioning(self, dataset: List[Dict]):
-        for item in dataset:
-            item["caption"] = get_vlm_output(
-                item["path"],
-                self.args["captioner"]["prompt"],
-                self.args["captioner"]["model"],
-            )
+        captions = get_vlm_outputs(
+            [item["path"] for item in dataset],
+            self.args["captioner"]["prompt"],
+            self.args["captioner"]["model"],
+        )
+        for item, caption in zip(dataset, captions):
+            item["caption"] = caption
 
     def get_captions(
         self, sampled_dataset1: List[Dict]
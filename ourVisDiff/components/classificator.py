@@ -4,7 +4,7 @@ from typing import Dict, List, Tuple
 import numpy as np
 from tqdm import tqdm
 
-from serve.utils_llm import get_llm_output
+from serve.utils_llm import get_llm_output, get_llm_outputs
 
 
 
@@ -68,17 +68,18 @@ Again, output either a 1, or 0. Response:"""
         scores = []
         evaluated_hypotheses = []
 
-        for i, caption in enumerate(test_captions):
-            if i < self.args["n_captions"]:
+        prompts = [
+            self.prompt.format(captions=caption, concepts_a=ai_hypotheses_string, concepts_b=nature_hypotheses_string)
+            for caption in test_captions[: self.args["n_captions"]]
+        ]
+        answers = get_llm_outputs(prompts, self.args["model"])
+        for prompt, answer in zip(prompts, answers):
+            score = self.calculate_score(answer)
+
+            evaluated_hypotheses.append({"prompt": prompt, "score": score, "response": answer})
 
-                prompt = self.prompt.format(captions=caption, concepts_a=ai_hypotheses_string, concepts_b=nature_hypotheses_string)
-                answer = get_llm_output(prompt, self.args["model"])
-                score = self.calculate_score(answer)
-                
-                evaluated_hypotheses.append({"prompt": prompt, "score": score, "response": answer})
-                    
-                if score == 0 or score == 1:  
-                    scores.append(score)
+            if score == 0 or score == 1:
+                scores.append(score)
 
         score = np.mean(scores)
         group = self.decide_group(score)
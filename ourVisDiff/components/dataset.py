@@ -0,0 +1,301 @@
+import collections.abc
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+INDEX_DIR = "cache/dataset_index"
+INDEX_VERSION = 2  # bumped when the stored layout changes
+DATASET_COLUMN = "__dataset__"
+# dtype kind of a CSV column -> cast that restores its values on row access.
+# Columns shared by CSVs of different dtypes are stored as strings.
+CASTS = {"b": lambda value: value in (True, "True"), "i": int, "f": float, "O": str}
+
+
+class DatasetIndex:
+    """
+    All CSVs of a data root in one columnar table. Rows are sorted by dataset
+    and group (keeping the CSV order within a group), so every group is a
+    contiguous range of rows.
+    """
+
+    def __init__(
+        self, columns: Dict[str, np.ndarray], nulls: Dict[str, np.ndarray], meta: Dict
+    ):
+        self.columns = columns
+        self.nulls = nulls  # column -> missing-value mask, for columns with any
+        self.dataset_columns = meta["dataset_columns"]  # dataset -> its CSV columns
+        self.dataset_dtypes = meta["dataset_dtypes"]  # dataset -> column -> kind
+        self.partitions = meta["partitions"]  # dataset -> group -> [start, end)
+
+    def get_group(self, dataset: str, group: str) -> "DatasetView":
+        start, end = self.partitions[dataset].get(group, (0, 0))
+        return DatasetView(self, np.arange(start, end), self.dataset_dtypes[dataset])
+
+    def get_group_names(self, dataset: str) -> List[str]:
+        return list(self.partitions[dataset].keys())
+
+
+class DatasetView(collections.abc.Sequence):
+    """
+    Rows of a DatasetIndex, usable wherever a list of row dicts is expected.
+    Dicts are only built for the rows that are accessed, with the values and
+    missing values (NaN) that DataFrame.to_dict("records") gives for the CSV.
+    Slicing, concatenation and column access work on the row numbers.
+    """
+
+    def __init__(
+        self, index: DatasetIndex, rows: np.ndarray, dtypes: Dict[str, str]
+    ):
+        self.index = index
+        self.rows = rows
+        self.dtypes = dtypes  # column -> dtype kind in the CSV
+        self.columns = list(dtypes.keys())
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return DatasetView(self.index, self.rows[i], self.dtypes)
+        row = self.rows[i]
+        return {column: self.get_value(column, row) for column in self.columns}
+
+    def get_value(self, column: str, row: int):
+        nulls = self.index.nulls.get(column)
+        if nulls is not None and nulls[row]:
+            return float("nan")
+        return CASTS[self.dtypes[column]](self.index.columns[column][row].item())
+
+    def __add__(self, other: "DatasetView") -> "DatasetView":
+        assert other.index is self.index, "Views must share an index"
+        return DatasetView(
+            self.index, np.concatenate([self.rows, other.rows]), self.dtypes
+        )
+
+    def column(self, name: str) -> np.ndarray:
+        return self.index.columns[name][self.rows]
+
+    def filter(self, name: str, value) -> "DatasetView":
+        rows = self.rows[self.column(name) == value]
+        return DatasetView(self.index, rows, self.dtypes)
+
+
+def get_paths(dataset: Sequence[Dict]) -> List[str]:
+    if isinstance(dataset, DatasetView):
+        return dataset.column("path").tolist()
+    return [item["path"] for item in dataset]
+
+
+def get_fingerprint(csv_files: List[str]) -> str:
+    stats = [os.stat(csv_file) for csv_file in csv_files]
+    return hashlib.sha256(
+        json.dumps(
+            [INDEX_VERSION]
+            + [
+                [csv_file, stat.st_mtime_ns, stat.st_size]
+                for csv_file, stat in zip(csv_files, stats)
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+def get_dtype_kind(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series):
+        return "b"
+    if pd.api.types.is_integer_dtype(series):
+        return "i"
+    if pd.api.types.is_float_dtype(series):
+        return "f"
+    return "O"
+
+
+def build_index(
+    csv_files: List[str],
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], Dict]:
+    """
+    Columns of all CSVs sorted by dataset and group, the missing-value masks of
+    the columns that have missing values, and the metadata of DatasetIndex.
+    """
+    frames = []
+    dataset_columns = {}
+    dataset_dtypes = {}
+    for csv_file in csv_files:
+        name = os.path.splitext(os.path.basename(csv_file))[0]
+        df = pd.read_csv(csv_file, sep=";")
+        dataset_columns[name] = list(df.columns)
+        dataset_dtypes[name] = {
+            column: get_dtype_kind(df[column]) for column in df.columns
+        }
+        df[DATASET_COLUMN] = name
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    # lexsort is stable, so rows keep their CSV order within a group
+    df = df.iloc[np.lexsort((df["group_name"].astype(str), df[DATASET_COLUMN]))]
+
+    columns = {}
+    nulls = {}
+    for column in df.columns:
+        if df[column].isna().any():
+            nulls[column] = df[column].isna().to_numpy()
+        if pd.api.types.is_numeric_dtype(df[column]):
+            columns[column] = df[column].to_numpy()
+        else:
+            columns[column] = df[column].fillna("").astype(str).to_numpy(dtype=str)
+
+    partitions = {}
+    keys = list(zip(columns[DATASET_COLUMN].tolist(), columns["group_name"].tolist()))
+    start = 0
+    for end in range(1, len(keys) + 1):
+        if end == len(keys) or keys[end] != keys[start]:
+            dataset, group = keys[start]
+            partitions.setdefault(dataset, {})[group] = [start, end]
+            start = end
+    meta = {
+        "dataset_columns": dataset_columns,
+        "dataset_dtypes": dataset_dtypes,
+        "partitions": partitions,
+    }
+    return columns, nulls, meta
+
+
+dataset_indexes = {}
+dataset_indexes_lock = threading.Lock()
+
+
+def load_dataset_index(root: str) -> DatasetIndex:
+    """
+    Load the index of all CSVs in root, once per process. The index is cached
+    in INDEX_DIR and rebuilt when a CSV is added, removed or modified.
+    """
+    csv_files = sorted(glob.glob(os.path.join(root, "*.csv")))
+    fingerprint = get_fingerprint(csv_files)
+    with dataset_indexes_lock:
+        if fingerprint in dataset_indexes:
+            return dataset_indexes[fingerprint]
+
+        index_file = os.path.join(INDEX_DIR, fingerprint + ".npz")
+        if os.path.exists(index_file):
+            with np.load(index_file) as data:
+                meta = json.loads(data["__meta__"].item())
+                columns = {
+                    key[len("column:") :]: data[key]
+                    for key in data.files
+                    if key.startswith("column:")
+                }
+                nulls = {
+                    key[len("null:") :]: data[key]
+                    for key in data.files
+                    if key.startswith("null:")
+                }
+        else:
+            logging.info(f"Indexing {len(csv_files)} CSVs in {root}")
+            columns, nulls, meta = build_index(csv_files)
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            with open(index_file + ".tmp", "wb") as f:
+                np.savez(
+                    f,
+                    __meta__=np.array(json.dumps(meta)),
+                    **{"column:" + key: value for key, value in columns.items()},
+                    **{"null:" + key: value for key, value in nulls.items()},
+                )
+            os.replace(index_file + ".tmp", index_file)
+
+        dataset_indexes[fingerprint] = DatasetIndex(columns, nulls, meta)
+        return dataset_indexes[fingerprint]
+
+
+def load_data(args: Dict) -> Tuple[Sequence[Dict], Sequence[Dict], List[str]]:
+    data_args = args["data"]
+    index = load_dataset_index(data_args["root"])
+    print(f"Name: {data_args['name']}")
+    dataset1 = index.get_group(data_args["name"], data_args["group1"])
+    dataset2 = index.get_group(data_args["name"], data_args["group2"])
+
+    if data_args["subset"]:
+        old_len = len(dataset1) + len(dataset2)
+        dataset1 = dataset1.filter("subset", data_args["subset"])
+        dataset2 = dataset2.filter("subset", data_args["subset"])
+        print(
+            f"Taking {data_args['subset']} subset (dataset size reduced from {old_len} to {len(dataset1) + len(dataset2)})"
+        )
+    print(f"Group name {index.get_group_names(data_args['name'])}")
+    group_names = [data_args["group1"], data_args["group2"]]
+
+    if data_args["purity"] < 1:
+        logging.warning(f"Purity is set to {data_args['purity']}. Swapping groups.")
+        assert len(dataset1) == len(dataset2), "Groups must be of equal size"
+        n_swap = int((1 - data_args["purity"]) * len(dataset1))
+        dataset1 = dataset1[n_swap:] + dataset2[:n_swap]
+        dataset2 = dataset2[n_swap:] + dataset1[:n_swap]
+    return dataset1, dataset2, group_names
+
+
+def test_rows_match_records():
+    import math
+    import tempfile
+
+    global INDEX_DIR
+    root = tempfile.mkdtemp()
+    INDEX_DIR = os.path.join(root, "index")
+    # a shares "score" with b at another dtype, and has NaNs in str/int columns
+    a = pd.DataFrame(
+        {
+            "path": ["a0.jpg", "a1.jpg", "a2.jpg", "a3.jpg"],
+            "group_name": ["x", "y", "x", "y"],
+            "subset": ["s", "s", "t", "s"],
+            "caption": ["a dog", None, "a cat", "a bird"],
+            "label": [3, 1, None, 2],
+            "count": [10, 20, 30, 40],
+            "score": [0.1, 0.2, 0.3, None],
+            "flag": [True, False, True, True],
+        }
+    )
+    b = pd.DataFrame(
+        {
+            "path": ["b0.jpg", "b1.jpg"],
+            "group_name": ["x", "y"],
+            "subset": [None, None],
+            "score": ["high", "low"],
+        }
+    )
+    a.to_csv(os.path.join(root, "a.csv"), sep=";", index=False)
+    b.to_csv(os.path.join(root, "b.csv"), sep=";", index=False)
+
+    def same(value, expected):
+        if isinstance(expected, float) and math.isnan(expected):
+            return isinstance(value, float) and math.isnan(value)
+        return type(value) is type(expected) and value == expected
+
+    for name in ["a", "b"]:
+        df = pd.read_csv(os.path.join(root, f"{name}.csv"), sep=";")
+        args = {
+            "data": {
+                "root": root,
+                "name": name,
+                "group1": "x",
+                "group2": "y",
+                "subset": None,
+                "purity": 1.0,
+            }
+        }
+        for _ in range(2):  # built, then loaded from INDEX_DIR
+            dataset_indexes.clear()
+            dataset1, dataset2, _ = load_data(args)
+            for dataset, group in [(dataset1, "x"), (dataset2, "y")]:
+                records = df[df["group_name"] == group].to_dict("records")
+                assert len(dataset) == len(records)
+                for row, record in zip(dataset, records):
+                    assert row.keys() == record.keys(), (row, record)
+                    for column in record:
+                        assert same(row[column], record[column]), (row, record)
+
+
+if __name__ == "__main__":
+    test_rows_match_records()
@@ -2,9 +2,8 @@ import argparse
 from typing import Dict, List, Tuple
 
 import numpy as np
-from tqdm import tqdm
 
-from serve.utils_llm import get_llm_output
+from serve.utils_llm import get_llm_outputs
 
 
 
@@ -35,9 +34,13 @@ Again, output either a 2, 1, or 0. Response:"""
         # verify that the hypothesis is true or false
         scores = []
         evaluated_hypotheses = []
-        for hypothesis in tqdm(hypotheses[: self.args["n_hypotheses"]]):
-            prompt = self.prompt.format(hypothesis=hypothesis, gt_a=gt_a, gt_b=gt_b)
-            answer = get_llm_output(prompt, self.args["model"])
+        hypotheses = hypotheses[: self.args["n_hypotheses"]]
+        prompts = [
+            self.prompt.format(hypothesis=hypothesis, gt_a=gt_a, gt_b=gt_b)
+            for hypothesis in hypotheses
+        ]
+        answers = get_llm_outputs(prompts, self.args["model"])
+        for hypothesis, answer in zip(hypotheses, answers):
             try:
                 scores.append(int(answer))
             except ValueError:
@@ -82,9 +85,13 @@ Again, output either a 2, 1, or 0. Response:"""
         # verify that the hypothesis is true or false
         scores = []
         evaluated_hypotheses = []
-        for hypothesis in tqdm(hypotheses[: self.args["n_hypotheses"]]):
-            prompt = self.prompt.format(hypothesis=hypothesis, gt_a=gt_a, gt_b=gt_b)
-            answer = get_llm_output(prompt, self.args["model"])
+        hypotheses = hypotheses[: self.args["n_hypotheses"]]
+        prompts = [
+            self.prompt.format(hypothesis=hypothesis, gt_a=gt_a, gt_b=gt_b)
+            for hypothesis in hypotheses
+        ]
+        answers = get_llm_outputs(prompts, self.args["model"])
+        for hypothesis, answer in zip(hypotheses, answers):
             try:
                 scores.append(int(answer))
             except ValueError:
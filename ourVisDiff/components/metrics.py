@@ -0,0 +1,100 @@
+from typing import Dict
+
+import numpy as np
+from scipy.stats import rankdata, ttest_ind
+from scipy.stats import t as student_t
+from sklearn.metrics import roc_auc_score
+
+
+def classify(similarity_A_C, similarity_B_C, threshold=0.3):
+    """
+    Given two arrays of cos sim scores, classify each item of each group as containing concept C or not.
+    Return P(hyp in A) - P(hyp in B)
+    """
+    similarity_A_C = np.array(similarity_A_C)
+    similarity_B_C = np.array(similarity_B_C)
+    # print(
+    #     f"avg(cos sim A, cos sim B) = {[np.mean(similarity_A_C), np.mean(similarity_B_C)]} \t Max(cos sim A, cos sim B) = {[np.max(similarity_A_C), np.max(similarity_B_C)]}"
+    # )
+    percent_correct_a = sum(similarity_A_C > threshold) / len(similarity_A_C)
+    percent_correct_b = sum(similarity_B_C > threshold) / len(similarity_B_C)
+    # print(f"Percent correct A, B {[percent_correct_a, percent_correct_b]}")
+    return percent_correct_a - percent_correct_b
+
+
+def compute_auroc(similarity_A_C, similarity_B_C):
+    similarity_A_C = np.array(similarity_A_C)
+    similarity_B_C = np.array(similarity_B_C)
+
+    # Create labels based on the sizes of the input arrays
+    labels_A = [1] * similarity_A_C.shape[0]
+    labels_B = [0] * similarity_B_C.shape[0]
+
+    # Concatenate scores and labels using numpy's concatenate
+    all_scores = np.concatenate([similarity_A_C, similarity_B_C], axis=0).ravel()
+    all_labels = labels_A + labels_B
+
+    # Compute AUROC
+    auroc = roc_auc_score(all_labels, all_scores)
+    return auroc
+
+
+def t_test(d_A, d_B):
+    d_A = np.array(d_A)
+    d_B = np.array(d_B)
+
+    # Assuming you've already defined your similarity scores d_A and d_B
+    t_stat, p_value = ttest_ind(d_A, d_B, equal_var=False)
+
+    # Decision
+    alpha = 0.05
+    if p_value < alpha:
+        # print("** Reject the null hypothesis - there's a significant difference between the groups. **")
+        return True, p_value
+    else:
+        # print("Fail to reject the null hypothesis - there's no significant difference between the groups.")
+        return False, p_value
+
+
+def compute_batch_metrics(
+    scores1: np.ndarray, scores2: np.ndarray, threshold: float = 0.3
+) -> Dict[str, np.ndarray]:
+    """
+    Vectorized metrics for H hypotheses at once, given (H x N1) scores on group A
+    and (H x N2) scores on group B. auroc and correct_delta match compute_auroc
+    and classify row by row, the AUROC being computed from ranks (Mann-Whitney
+    U). t_stat is the Welch t statistic itself; significant and p_value are what
+    t_test returns.
+    """
+    scores1 = np.asarray(scores1, dtype=np.float64)
+    scores2 = np.asarray(scores2, dtype=np.float64)
+    n1, n2 = scores1.shape[1], scores2.shape[1]
+
+    mean1 = scores1.mean(axis=1)
+    mean2 = scores2.mean(axis=1)
+
+    # Welch's t-test
+    se1 = scores1.var(axis=1, ddof=1) / n1
+    se2 = scores2.var(axis=1, ddof=1) / n2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_stat = (mean1 - mean2) / np.sqrt(se1 + se2)
+        dof = (se1 + se2) ** 2 / (se1**2 / (n1 - 1) + se2**2 / (n2 - 1))
+    p_value = 2 * student_t.sf(np.abs(t_stat), dof)
+
+    # AUROC = U / (n1 * n2) with ties receiving their average rank
+    ranks = rankdata(np.concatenate([scores1, scores2], axis=1), axis=1)
+    auroc = (ranks[:, :n1].sum(axis=1) - n1 * (n1 + 1) / 2) / (n1 * n2)
+
+    correct_delta = (scores1 > threshold).mean(axis=1) - (scores2 > threshold).mean(
+        axis=1
+    )
+    return {
+        "score1": mean1,
+        "score2": mean2,
+        "diff": mean1 - mean2,
+        "t_stat": t_stat,
+        "significant": p_value < 0.05,
+        "p_value": p_value,
+        "auroc": auroc,
+        "correct_delta": correct_delta,
+    }
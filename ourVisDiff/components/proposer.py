@@ -9,9 +9,9 @@ from PIL import Image
 
 import components.prompts as prompts
 import wandb
-from serve.utils_general import save_data_diff_image
+from serve.utils_general import get_image_ids, save_data_diff_image
 from serve.utils_llm import get_llm_output
-from serve.utils_vlm import get_embed_caption_blip, get_vlm_output
+from serve.utils_vlm import get_embed_caption_blip, get_vlm_output, get_vlm_outputs
 
 
 class Proposer:
@@ -27,7 +27,8 @@ class Proposer:
         all_hypotheses = []
         all_logs = []
         all_images = []
-        random.seed(self.args["seed"])
+        # per instance instead of the global seed, so proposers can run in threads
+        self.rng = random.Random(self.args["seed"])
         for i in range(self.args["num_rounds"]):
             sampled_dataset1 = self.sample(dataset1, self.args["num_samples"])
             sampled_dataset2 = self.sample(dataset2, self.args["num_samples"])
@@ -44,7 +45,7 @@ class Proposer:
         raise NotImplementedError
 
     def sample(self, dataset: List[Dict], n: int) -> List[Dict]:
-        return random.sample(dataset, n)
+        return self.rng.sample(dataset, n)
 
     def visualize(
         self, sampled_dataset1: List[Dict], sampled_dataset2: List[Dict]
@@ -67,12 +68,13 @@ class Proposer:
         return images
 
     def captioning(self, dataset: List[Dict]):
-        for item in dataset:
-            item["caption"] = get_vlm_output(
-                item["path"],
-                self.args["captioner"]["prompt"],
-                self.args["captioner"]["model"],
-            )
+        captions = get_vlm_outputs(
+            [item["path"] for item in dataset],
+            self.args["captioner"]["prompt"],
+            self.args["captioner"]["model"],
+        )
+        for item, caption in zip(dataset, captions):
+            item["caption"] = caption
 
 
 class LLMProposer(Proposer):
@@ -112,7 +114,7 @@ class LLMProposerDiffusion(LLMProposer):
         all_hypotheses = []
         all_logs = []
         all_images = []
-        random.seed(self.args["seed"])
+        self.rng = random.Random(self.args["seed"])
         for i in range(self.args["num_rounds"]):
             sampled_dataset1 = self.sample(dataset1, self.args["num_samples"])
             sampled_prompts = [
@@ -172,11 +174,13 @@ class VLMProposer(Proposer):
         ), "Groups must be of equal size"
         assert len(sampled_dataset1) <= 20, "Groups must be smaller than 20"
         filenames = [item["path"] for item in sampled_dataset1 + sampled_dataset2]
-        save_name = hashlib.sha256(json.dumps(filenames).encode()).hexdigest()
+        image_ids = get_image_ids(filenames)
+        save_name = hashlib.sha256(json.dumps(image_ids).encode()).hexdigest()
 
         image_path = f"cache/images/{save_name}.png"
         os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        save_data_diff_image(sampled_dataset1, sampled_dataset2, image_path)
+        if not os.path.exists(image_path):
+            save_data_diff_image(sampled_dataset1, sampled_dataset2, image_path)
         output = get_vlm_output(image_path, self.prompt, self.args["model"])
         output = output.replace("</s>", " ").strip()  # remove </s> token for llava
         hypotheses = [line.replace("* ", "") for line in output.splitlines()]
@@ -1,24 +1,27 @@
 import random
-from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
-from scipy.stats import ttest_ind
-from sklearn.metrics import roc_auc_score
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 import wandb
+from components.dataset import get_paths
+from components.metrics import classify, compute_auroc, compute_batch_metrics, t_test
 from serve.utils_clip import get_embeddings
-from serve.utils_llm import get_llm_output
-from serve.utils_vlm import get_vlm_output
+from serve.utils_llm import get_llm_outputs
+from serve.utils_vlm import get_vlm_output, get_vlm_outputs
 
 
 def plot_distributions(similarity_A_C, similarity_B_C, hypothesis=""):
     """
     Plots the distributions of cos sim to hypothesis for each group.
     """
+    # plotting libraries are only loaded once something is plotted
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
     # Convert arrays to 1D if they're 2D
     similarity_A_C = np.array(similarity_A_C).ravel()
     similarity_B_C = np.array(similarity_B_C).ravel()
@@ -30,8 +33,10 @@ def plot_distributions(similarity_A_C, similarity_B_C, hypothesis=""):
     # Create a DataFrame for seaborn plotting
     df = pd.DataFrame({"Group": labels, "Similarity to C": all_scores})
 
-    # Set up the figure with 3 subplots
-    fig, ax = plt.subplots(nrows=1, ncols=3, figsize=(20, 5))
+    # Set up the figure with 3 subplots. The figure is not registered with pyplot,
+    # so it can be rendered off the main thread and is freed once dereferenced.
+    fig = Figure(figsize=(20, 5))
+    ax = fig.subplots(nrows=1, ncols=3)
 
     # Histogram
     ax[0].hist(similarity_A_C, bins=30, alpha=0.5, label="Group A", density=True)
@@ -53,120 +58,205 @@ def plot_distributions(similarity_A_C, similarity_B_C, hypothesis=""):
     ax[2].set_title(f"Boxplot of Cosine Similarities to \n{hypothesis}")
 
     # Adjust layout
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
 
-def classify(similarity_A_C, similarity_B_C, threshold=0.3):
-    """
-    Given two arrays of cos sim scores, classify each item of each group as containing concept C or not.
-    Return P(hyp in A) - P(hyp in B)
-    """
-    similarity_A_C = np.array(similarity_A_C)
-    similarity_B_C = np.array(similarity_B_C)
-    # print(
-    #     f"avg(cos sim A, cos sim B) = {[np.mean(similarity_A_C), np.mean(similarity_B_C)]} \t Max(cos sim A, cos sim B) = {[np.max(similarity_A_C), np.max(similarity_B_C)]}"
-    # )
-    percent_correct_a = sum(similarity_A_C > threshold) / len(similarity_A_C)
-    percent_correct_b = sum(similarity_B_C > threshold) / len(similarity_B_C)
-    # print(f"Percent correct A, B {[percent_correct_a, percent_correct_b]}")
-    return percent_correct_a - percent_correct_b
-
-
-def compute_auroc(similarity_A_C, similarity_B_C):
-    similarity_A_C = np.array(similarity_A_C)
-    similarity_B_C = np.array(similarity_B_C)
-
-    # Create labels based on the sizes of the input arrays
-    labels_A = [1] * similarity_A_C.shape[0]
-    labels_B = [0] * similarity_B_C.shape[0]
-
-    # Concatenate scores and labels using numpy's concatenate
-    all_scores = np.concatenate([similarity_A_C, similarity_B_C], axis=0).ravel()
-    all_labels = labels_A + labels_B
+def render_distribution(similarity_A_C, similarity_B_C, hypothesis: str) -> wandb.Image:
+    fig = plot_distributions(similarity_A_C, similarity_B_C, hypothesis=hypothesis)
+    image = wandb.Image(fig)
+    fig.clear()
+    return image
 
-    # Compute AUROC
-    auroc = roc_auc_score(all_labels, all_scores)
-    return auroc
 
+_plot_executor = None
 
-def t_test(d_A, d_B):
-    d_A = np.array(d_A)
-    d_B = np.array(d_B)
 
-    # Assuming you've already defined your similarity scores d_A and d_B
-    t_stat, p_value = ttest_ind(d_A, d_B, equal_var=False)
-
-    # Decision
-    alpha = 0.05
-    if p_value < alpha:
-        # print("** Reject the null hypothesis - there's a significant difference between the groups. **")
-        return True, p_value
-    else:
-        # print("Fail to reject the null hypothesis - there's no significant difference between the groups.")
-        return False, p_value
+def get_plot_executor() -> ThreadPoolExecutor:
+    global _plot_executor
+    if _plot_executor is None:
+        _plot_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="plot_distributions"
+        )
+    return _plot_executor
 
 
 class Ranker:
     def __init__(self, args: Dict):
         self.args = args
+        # id(metrics) -> (metrics, scores1, scores2), kept in "deferred" plotting
+        # mode. Holding metrics keeps its id from being reused before rendering.
+        self.pending_distributions = {}
 
     def score_hypothesis(self, hypothesis: str, dataset: List[dict]) -> List[float]:
         raise NotImplementedError
 
+    def score_hypotheses(
+        self, hypotheses: List[str], dataset: List[dict]
+    ) -> List[List[float]]:
+        """
+        Score every hypothesis on the dataset. Rankers that can share work across
+        hypotheses override this instead of score_hypothesis.
+        """
+        return [
+            self.score_hypothesis(hypothesis, dataset)
+            for hypothesis in tqdm(hypotheses)
+        ]
+
     def rerank_hypotheses(
-        self, hypotheses: List[str], dataset1: List[dict], dataset2: List[dict]
+        self,
+        hypotheses: List[str],
+        dataset1: List[dict],
+        dataset2: List[dict],
+        defer_plots: bool = False,
     ) -> List[dict]:
+        """
+        Score and sort hypotheses by AUROC. With defer_plots, the scores of a
+        "deferred" plot_distributions ranker are kept until the caller passes the
+        result to render_distributions; otherwise no plotting state is kept.
+        """
         if len(dataset1) > self.args["max_num_samples"]:
-            random.seed(self.args["seed"])
-            dataset1 = random.sample(dataset1, self.args["max_num_samples"])
+            rng = random.Random(self.args["seed"])
+            dataset1 = rng.sample(dataset1, self.args["max_num_samples"])
         if len(dataset2) > self.args["max_num_samples"]:
-            random.seed(self.args["seed"])
-            dataset2 = random.sample(dataset2, self.args["max_num_samples"])
+            rng = random.Random(self.args["seed"])
+            dataset2 = rng.sample(dataset2, self.args["max_num_samples"])
 
-        scored_hypotheses = []
-        for hypothesis in tqdm(hypotheses):
-            scores1 = self.score_hypothesis(hypothesis, dataset1)
-            scores2 = self.score_hypothesis(hypothesis, dataset2)
+        all_scores1 = self.score_hypotheses(hypotheses, dataset1)
+        all_scores2 = self.score_hypotheses(hypotheses, dataset2)
 
-            metrics = self.compute_metrics(scores1, scores2, hypothesis)
-            scored_hypotheses.append(metrics)
+        is_matrix = all(
+            len({len(scores) for scores in all_scores}) <= 1
+            for all_scores in [all_scores1, all_scores2]
+        )
+        if is_matrix:
+            scored_hypotheses = self.compute_all_metrics(
+                all_scores1, all_scores2, hypotheses, defer_plots
+            )
+        else:
+            # rankers that drop invalid answers return a different number of
+            # scores per hypothesis, which cannot be stacked into a matrix
+            scored_hypotheses = [
+                self.compute_metrics(scores1, scores2, hypothesis, defer_plots)
+                for hypothesis, scores1, scores2 in zip(
+                    hypotheses, all_scores1, all_scores2
+                )
+            ]
         scored_hypotheses = sorted(
             scored_hypotheses, key=lambda x: x["auroc"], reverse=True
         )
         return scored_hypotheses
 
     def compute_metrics(
-        self, scores1: List[float], scores2: List[float], hypothesis: str
+        self,
+        scores1: List[float],
+        scores2: List[float],
+        hypothesis: str,
+        defer_plots: bool = False,
     ) -> dict:
-        metrics = {}
-        metrics["hypothesis"] = hypothesis
-        metrics["score1"] = np.mean(scores1)
-        metrics["score2"] = np.mean(scores2)
-        metrics["diff"] = metrics["score1"] - metrics["score2"]
-        metrics["t_stat"], metrics["p_value"] = t_test(scores1, scores2)
-        metrics["auroc"] = compute_auroc(scores1, scores2)
-        metrics["correct_delta"] = classify(
-            scores1, scores2, threshold=self.args["classify_threshold"]
-        )
-        metrics["distribution"] = wandb.Image(
-            plot_distributions(scores1, scores2, hypothesis=hypothesis)
+        return self.compute_all_metrics(
+            [scores1], [scores2], [hypothesis], defer_plots
+        )[0]
+
+    def compute_all_metrics(
+        self,
+        all_scores1: np.ndarray,
+        all_scores2: np.ndarray,
+        hypotheses: List[str],
+        defer_plots: bool = False,
+    ) -> List[dict]:
+        """
+        Compute the metrics of all hypotheses in one vectorized pass. Distribution
+        plots are only rendered if the ranker is configured with plot_distributions:
+        true renders them here, "deferred" keeps the scores (only if defer_plots)
+        so that render_distributions can plot the top hypotheses later.
+        """
+        if len(hypotheses) == 0:
+            return []
+        batch_metrics = compute_batch_metrics(
+            all_scores1, all_scores2, threshold=self.args["classify_threshold"]
         )
-        return metrics
+        all_metrics = []
+        for i, hypothesis in enumerate(hypotheses):
+            metrics = {"hypothesis": hypothesis}
+            for name, values in batch_metrics.items():
+                metrics[name] = values[i].item()
+            plot_mode = self.args.get("plot_distributions", False)
+            if plot_mode == "deferred":
+                if defer_plots:
+                    # keyed by row, a batch can contain the same hypothesis twice
+                    self.pending_distributions[id(metrics)] = (
+                        metrics,
+                        all_scores1[i],
+                        all_scores2[i],
+                    )
+            elif plot_mode:
+                metrics["distribution"] = render_distribution(
+                    all_scores1[i], all_scores2[i], hypothesis
+                )
+            all_metrics.append(metrics)
+        return all_metrics
+
+    def render_distributions(
+        self, scored_hypotheses: List[dict], top_k: Optional[int] = None
+    ) -> Future:
+        """
+        Plot the deferred distributions of the top_k (default: plot_top_k) scored
+        hypotheses on a background worker. The returned future resolves once the
+        "distribution" entries are attached to scored_hypotheses. The scores of
+        the remaining hypotheses are dropped.
+        """
+        if top_k is None:
+            top_k = self.args.get("plot_top_k", 5)
+        jobs = []
+        for rank, metrics in enumerate(scored_hypotheses):
+            pending = self.pending_distributions.pop(id(metrics), None)
+            if pending is not None and rank < top_k:
+                jobs.append((metrics, pending[1:]))
+        if not jobs:
+            # nothing to plot, keep the background worker free
+            done = Future()
+            done.set_result(scored_hypotheses)
+            return done
+
+        def render():
+            for metrics, (scores1, scores2) in jobs:
+                metrics["distribution"] = render_distribution(
+                    scores1, scores2, metrics["hypothesis"]
+                )
+            return scored_hypotheses
+
+        return get_plot_executor().submit(render)
 
 
 class CLIPRanker(Ranker):
     def __init__(self, args: Dict):
         super().__init__(args)
+        self.image_features = {}
+
+    def get_image_features(self, dataset: List[dict]) -> np.ndarray:
+        """
+        Load the (N x D) image embedding matrix of a dataset once and reuse it
+        for all hypotheses and all rerank_hypotheses calls on this ranker.
+        """
+        paths = tuple(get_paths(dataset))
+        if paths not in self.image_features:
+            self.image_features[paths] = get_embeddings(
+                list(paths), self.args["clip_model"], "image"
+            )
+        return self.image_features[paths]
+
+    def score_hypotheses(
+        self, hypotheses: List[str], dataset: List[dict]
+    ) -> np.ndarray:
+        if len(hypotheses) == 0:
+            return np.zeros((0, len(dataset)), dtype=np.float32)
+        image_features = self.get_image_features(dataset)
+        text_features = get_embeddings(hypotheses, self.args["clip_model"], "text")
+        return text_features @ image_features.T  # (H x N)
 
     def score_hypothesis(self, hypothesis: str, dataset: List[dict]) -> List[float]:
-        image_features = get_embeddings(
-            [item["path"] for item in dataset], self.args["clip_model"], "image"
-        )
-        text_features = get_embeddings([hypothesis], self.args["clip_model"], "text")
-        similarity = image_features @ text_features.T
-        scores = similarity.squeeze(1).tolist()
-        return scores
+        return self.score_hypotheses([hypothesis], dataset)[0].tolist()
 
 
 class VLMRanker(Ranker):
@@ -176,10 +266,9 @@ class VLMRanker(Ranker):
     def score_hypothesis(self, hypothesis: str, dataset: List[dict]) -> List[float]:
         scores = []
         invalid_scores = []
-        for i in trange(0, len(dataset)):
-            item = dataset[i]
-            prompt = f"Does this image contain {hypothesis.replace('and ', '')}?"  # TODO: why this prompt
-            output = get_vlm_output(item["path"], prompt, self.args["model"])
+        prompt = f"Does this image contain {hypothesis.replace('and ', '')}?"  # TODO: why this prompt
+        outputs = get_vlm_outputs(get_paths(dataset), prompt, self.args["model"])
+        for output in outputs:
             if "yes" in output.lower():
                 scores.append(1)
             elif "no" in output.lower():
@@ -191,24 +280,7 @@ class VLMRanker(Ranker):
 
 
 class LLMRanker(Ranker):
-    def __init__(self, args: Dict):
-        super().__init__(args)
-
-    def score_hypothesis(self, hypothesis: str, dataset: List[dict]) -> List[float]:
-        scores = []
-        invalid_scores = []
-        for i in trange(0, len(dataset)):
-            item = dataset[i]
-            caption = (
-                get_vlm_output(
-                    item["path"],
-                    self.args["captioner_prompt"],
-                    self.args["captioner_model"],
-                )
-                .replace("\n", " ")
-                .strip()
-            )
-            prompt = f"""Given a caption and a concept, respond with yes or no.
+    prompt = """Given a caption and a concept, respond with yes or no.
 Here are 5 examples for the concept "spider and a flower":
 INPUT: a spider sitting on top of a purple flower
 OUTPUT: yes
@@ -237,15 +309,49 @@ OUTPUT: no
 
 Given the caption "{caption}" and the concept "{hypothesis}", respond with either the word yes or no ONLY.
 OUTPUT:"""
-            output = get_llm_output(prompt, self.args["model"])
-            if "yes" in output.lower():
-                scores.append(1)
-            elif "no" in output.lower():
-                scores.append(0)
-            else:
-                invalid_scores.append(output)
-        print(f"Percent Invalid {len(invalid_scores) / len(dataset)}")
-        return scores
+
+    def __init__(self, args: Dict):
+        super().__init__(args)
+
+    def score_hypotheses(
+        self, hypotheses: List[str], dataset: List[dict]
+    ) -> List[List[float]]:
+        """
+        Caption the dataset once and send the prompts of all hypotheses as one
+        concurrent batch.
+        """
+        captions = [
+            caption.replace("\n", " ").strip()
+            for caption in get_vlm_outputs(
+                get_paths(dataset),
+                self.args["captioner_prompt"],
+                self.args["captioner_model"],
+            )
+        ]
+        prompts = [
+            self.prompt.format(caption=caption, hypothesis=hypothesis)
+            for hypothesis in hypotheses
+            for caption in captions
+        ]
+        outputs = get_llm_outputs(prompts, self.args["model"])
+
+        all_scores = []
+        for i in range(len(hypotheses)):
+            scores = []
+            invalid_scores = []
+            for output in outputs[i * len(dataset) : (i + 1) * len(dataset)]:
+                if "yes" in output.lower():
+                    scores.append(1)
+                elif "no" in output.lower():
+                    scores.append(0)
+                else:
+                    invalid_scores.append(output)
+            print(f"Percent Invalid {len(invalid_scores) / len(dataset)}")
+            all_scores.append(scores)
+        return all_scores
+
+    def score_hypothesis(self, hypothesis: str, dataset: List[dict]) -> List[float]:
+        return self.score_hypotheses([hypothesis], dataset)[0]
 
 
 class NullRanker(Ranker):
@@ -256,6 +362,31 @@ class NullRanker(Ranker):
         return [0.0] * len(dataset)
 
 
+def test_deferred_distributions():
+    class FixedRanker(Ranker):
+        def score_hypothesis(self, hypothesis, dataset):
+            return [item["score"] + len(hypothesis) for item in dataset]
+
+    args = {
+        "max_num_samples": 100,
+        "seed": 0,
+        "classify_threshold": 0.3,
+        "plot_distributions": "deferred",
+    }
+    dataset1 = [{"score": 0.1 * i} for i in range(10)]
+    dataset2 = [{"score": 0.05 * i} for i in range(10)]
+    hypotheses = ["A cat", "Food", "A cat"]
+
+    ranker = FixedRanker(args)
+    ranker.rerank_hypotheses(hypotheses, dataset1, dataset2)
+    assert ranker.pending_distributions == {}, "rerank alone kept plotting state"
+
+    scored = ranker.rerank_hypotheses(hypotheses, dataset1, dataset2, defer_plots=True)
+    assert len(ranker.pending_distributions) == len(hypotheses)
+    ranker.render_distributions(scored, top_k=0).result()
+    assert ranker.pending_distributions == {}
+
+
 def test_rankers():
     args = {
         "clip_model": "ViT-bigG-14",
@@ -288,4 +419,5 @@ def test_rankers():
 
 
 if __name__ == "__main__":
+    test_deferred_distributions()
     test_rankers()
@@ -1,5 +1,8 @@
+import copy
 import logging
-from typing import Dict, List, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
 import os
 
 import click
@@ -8,6 +11,7 @@ from omegaconf import OmegaConf
 from tqdm import tqdm
 
 import wandb
+from components.dataset import load_data
 from components.evaluator import GPTEvaluator, NullEvaluator
 from components.proposer import (
     LLMProposer,
@@ -34,33 +38,6 @@ def load_config(config: str) -> Dict:
     return args
 
 
-def load_data(args: Dict) -> Tuple[List[Dict], List[Dict], List[str]]:
-    data_args = args["data"]
-    print(f"Name: {data_args['name']}")
-    print(f"{data_args['root']}/{data_args['name']}.csv")
-    df = pd.read_csv(f"{data_args['root']}/{data_args['name']}.csv", sep=";")
-    print(f"Row One {df.keys()}")
-
-    if data_args["subset"]:
-        old_len = len(df)
-        df = df[df["subset"] == data_args["subset"]]
-        print(
-            f"Taking {data_args['subset']} subset (dataset size reduced from {old_len} to {len(df)})"
-        )
-    print(f"Group name {df['group_name'].unique()}")
-    dataset1 = df[df["group_name"] == data_args["group1"]].to_dict("records")
-    dataset2 = df[df["group_name"] == data_args["group2"]].to_dict("records")
-    group_names = [data_args["group1"], data_args["group2"]]
-
-    if data_args["purity"] < 1:
-        logging.warning(f"Purity is set to {data_args['purity']}. Swapping groups.")
-        assert len(dataset1) == len(dataset2), "Groups must be of equal size"
-        n_swap = int((1 - data_args["purity"]) * len(dataset1))
-        dataset1 = dataset1[n_swap:] + dataset2[:n_swap]
-        dataset2 = dataset2[n_swap:] + dataset1[:n_swap]
-    return dataset1, dataset2, group_names
-
-
 def propose(args: Dict, dataset1: List[Dict], dataset2: List[Dict], name_str) -> List[str]:
     proposer_args = args["proposer"]
     proposer_args["seed"] = args["seed"]
@@ -84,53 +61,114 @@ def propose(args: Dict, dataset1: List[Dict], dataset2: List[Dict], name_str) ->
     return hypotheses
 
 
+def save_hypotheses(hypotheses: List[str], path: str):
+    # written to a temporary file first, so an interrupted run leaves no partial output
+    with open(path + ".tmp", "w") as f:
+        for hypothesis in hypotheses:
+            if hypothesis.startswith('"') and hypothesis.endswith('"'):
+                hypothesis = hypothesis[1:-1]
+            f.write(hypothesis + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def get_output_paths(split: str, name: str) -> Dict[str, str]:
+    return {
+        group: split + "_results/hypotheses_" + group + "_" + name + ".txt"
+        for group in ["ai", "nature"]
+    }
+
+
+def process_dataset(args: Dict, name: str, split: str) -> Dict:
+    """
+    Propose and save the hypotheses of both groups of one dataset. Returns the
+    seconds spent in each stage.
+    """
+    args = copy.deepcopy(args)  # every job sets its own data and proposer args
+    args["data"]["name"] = name
+    args["data"]["group1"] = "nature" + name[name.find('_'):]
+    args["data"]["group2"] = "ai" + name[name.find('_'):]
+    timings = {"name": name}
+
+    logging.info("Loading data " + name)
+    start = time.perf_counter()
+    dataset1, dataset2, group_names = load_data(args)
+    print(group_names, len(dataset1), len(dataset2))
+    timings["load"] = time.perf_counter() - start
+
+    logging.info("Proposing hypotheses " + name)
+    start = time.perf_counter()
+    nature_hypotheses = propose(args, dataset1, dataset2, "nature")
+    timings["propose_nature"] = time.perf_counter() - start
+    start = time.perf_counter()
+    ai_hypotheses = propose(args, dataset2, dataset1, "ai")
+    timings["propose_ai"] = time.perf_counter() - start
+
+    output_paths = get_output_paths(split, name)
+    save_hypotheses(ai_hypotheses, output_paths["ai"])
+    save_hypotheses(nature_hypotheses, output_paths["nature"])
+    timings["total"] = timings["load"] + timings["propose_nature"] + timings["propose_ai"]
+    return timings
 
 
 @click.command()
 @click.option("--config", help="config file")
-def main(config):
+@click.option(
+    "--jobs",
+    default=1,
+    help="datasets processed in parallel (VLM and LLM requests stay bounded by "
+    "VLM_MAX_CONCURRENCY and LLM_MAX_CONCURRENCY)",
+)
+@click.option(
+    "--overwrite", is_flag=True, help="also redo datasets with saved hypotheses"
+)
+def main(config, jobs, overwrite):
     logging.info("Loading config...")
     args = load_config(config)
     print(f"Args {args}")
 
     split = "train"
     args["data"]["root"] = "../" + split
+    os.makedirs(split + "_results", exist_ok=True)
 
     # get all folder names
-    csv_names = os.listdir('../' + split)
+    csv_names = sorted(os.listdir('../' + split))
     folder_names = []
     for csv_name in csv_names:
         folder_names.append(csv_name.split('.')[0])
 
-    for name in folder_names:
-
-        print()
-        print()
-        logging.info("Processing name " + name)
-        args["data"]["name"] = name
-        args["data"]["group1"] = "nature" + name[name.find('_'):]
-        args["data"]["group2"] = "ai" + name[name.find('_'):]
-
-        logging.info("Loading data...")
-        dataset1, dataset2, group_names = load_data(args)
-        print(group_names, len(dataset1), len(dataset2))
-
-        logging.info("Proposing hypotheses...")
-        nature_hypotheses = propose(args, dataset1, dataset2, "nature")
-        ai_hypotheses = propose(args, dataset2, dataset1, "ai")
-
-        logging.info("Saving hypotheses...")
-        with open(split + "_results/hypotheses_ai_" + args["data"]["name"] + ".txt", "w") as f:
-            for hypothesis in ai_hypotheses:
-                if hypothesis.startswith('"') and hypothesis.endswith('"'):
-                    hypothesis = hypothesis[1:-1]
-                f.write(hypothesis + "\n")
-
-        with open(split + "_results/hypotheses_nature_" + args["data"]["name"] + ".txt", "w") as f:
-            for hypothesis in nature_hypotheses:
-                if hypothesis.startswith('"') and hypothesis.endswith('"'):
-                    hypothesis = hypothesis[1:-1]
-                f.write(hypothesis + "\n")
+    if not overwrite:
+        done = [
+            name
+            for name in folder_names
+            if all(os.path.exists(path) for path in get_output_paths(split, name).values())
+        ]
+        logging.info(f"Skipping {len(done)} datasets with saved hypotheses")
+        folder_names = [name for name in folder_names if name not in done]
+
+    # Jobs are threads: they spend their time waiting on the VLM and LLM servers,
+    # and the per-server semaphores then bound the requests of all jobs together.
+    all_timings = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(process_dataset, args, name, split): name
+            for name in folder_names
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                all_timings.append(future.result())
+            except Exception:
+                logging.exception("Failed on " + futures[future])
+                failed.append(futures[future])
+
+    if all_timings:
+        timings = pd.DataFrame(all_timings).sort_values("total", ascending=False)
+        print(timings.to_string(index=False, float_format="%.1f"))
+        timings.to_csv(split + "_results/timings_gen_h.csv", index=False)
+        if args["wandb"]:
+            wandb.log({"timings": wandb.Table(dataframe=timings)})
+    if failed:
+        logging.error(f"Failed on {len(failed)} datasets: {failed}")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List
 import os
 
 import click
@@ -8,6 +8,7 @@ from omegaconf import OmegaConf
 from tqdm import tqdm
 
 import wandb
+from components.dataset import load_data
 from components.evaluator import GPTEvaluator, NullEvaluator
 from components.proposer import (
     LLMProposer,
@@ -34,34 +35,6 @@ def load_config(config: str) -> Dict:
     return args
 
 
-def load_data(args: Dict) -> Tuple[List[Dict], List[Dict], List[str]]:
-    data_args = args["data"]
-    print(f"Name: {data_args['name']}")
-    print(f"{data_args['root']}/{data_args['name']}.csv")
-    df = pd.read_csv(f"{data_args['root']}/{data_args['name']}.csv", sep=";")
-    print(f"Row One {df.keys()}")
-
-    if data_args["subset"]:
-        old_len = len(df)
-        df = df[df["subset"] == data_args["subset"]]
-        print(
-            f"Taking {data_args['subset']} subset (dataset size reduced from {old_len} to {len(df)})"
-        )
-    print(f"Group name {df['group_name'].unique()}")
-    dataset1 = df[df["group_name"] == data_args["group1"]].to_dict("records")
-    dataset2 = df[df["group_name"] == data_args["group2"]].to_dict("records")
-    group_names = [data_args["group1"], data_args["group2"]]
-
-    if data_args["purity"] < 1:
-        logging.warning(f"Purity is set to {data_args['purity']}. Swapping groups.")
-        assert len(dataset1) == len(dataset2), "Groups must be of equal size"
-        n_swap = int((1 - data_args["purity"]) * len(dataset1))
-        dataset1 = dataset1[n_swap:] + dataset2[:n_swap]
-        dataset2 = dataset2[n_swap:] + dataset1[:n_swap]
-    return dataset1, dataset2, group_names
-
-
-
 def rank(
     args: Dict,
     hypotheses: List[str],
@@ -71,11 +44,28 @@ def rank(
 ) -> List[str]:
     ranker_args = args["ranker"]
     ranker_args["seed"] = args["seed"]
+    if not args["wandb"]:
+        # distribution plots are only used for wandb logging
+        ranker_args["plot_distributions"] = False
 
     ranker = eval(ranker_args["method"])(ranker_args)
 
-    scored_hypotheses = ranker.rerank_hypotheses(hypotheses, dataset1, dataset2)
+    # deferred distribution plots render in the background while the
+    # ground truth is being ranked
+    scored_hypotheses = ranker.rerank_hypotheses(
+        hypotheses, dataset1, dataset2, defer_plots=True
+    )
+    plotted_hypotheses = ranker.render_distributions(scored_hypotheses)
+    scored_groundtruth = ranker.rerank_hypotheses(
+        group_names,
+        dataset1,
+        dataset2,
+        defer_plots=True,
+    )
+    plotted_groundtruth = ranker.render_distributions(scored_groundtruth)
+
     if args["wandb"]:
+        plotted_hypotheses.result()
         table_hypotheses = wandb.Table(dataframe=pd.DataFrame(scored_hypotheses))
         wandb.log({"scored hypotheses_" + args["data"]["name"]: table_hypotheses})
         for i in range(5):
@@ -84,12 +74,7 @@ def rank(
             ].replace('"', "")
             wandb.summary[f"top_{i + 1}_score"] = scored_hypotheses[i]["auroc"]
 
-    scored_groundtruth = ranker.rerank_hypotheses(
-        group_names,
-        dataset1,
-        dataset2,
-    )
-    if args["wandb"]:
+        plotted_groundtruth.result()
         table_groundtruth = wandb.Table(dataframe=pd.DataFrame(scored_groundtruth))
         wandb.log({"scored groundtruth_" + args["data"]["name"]: table_groundtruth})
 
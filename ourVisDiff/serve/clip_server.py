@@ -1,14 +1,20 @@
+import contextlib
+import io
 import json
 import logging
+import os
+import time
 from typing import List
 
 import numpy as np
 import open_clip
 import torch
 import torch.nn.functional as F
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from PIL import Image
-from tqdm import trange
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm, trange
+
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +22,31 @@ logging.basicConfig(level=logging.INFO)
 CLIP_MODEL = "ViT-bigG-14"
 CLIP_DATASET = "laion2b_s39b_b160k"
 BATCH_SIZE = 100
-DEVICE = "cuda"
+NUM_WORKERS = 8  # processes decoding and preprocessing images ahead of the GPU
+RESPONSE_MIMETYPES = ["application/json", "application/octet-stream", "application/x-npy"]
+RESPONSE_DTYPE = "float16"  # dtype of binary responses unless the request sets "dtype"
+
+# Inference backend, configurable per host through environment variables:
+#   CLIP_DEVICE       cuda | cpu (default: cuda if available)
+#   CLIP_PRECISION    fp32 | fp16 | bf16 | int8 (default: fp16 on cuda, fp32 on cpu)
+#                     fp16/bf16 run under autocast, int8 is dynamic quantization (cpu)
+#   CLIP_NUM_THREADS  intra-op threads on cpu (default: all cores)
+#   CLIP_BENCHMARK    measure and log throughput on startup (default: 1)
+DEVICE = os.environ.get("CLIP_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+DEVICE_TYPE = torch.device(DEVICE).type
+PRECISION = os.environ.get("CLIP_PRECISION", "fp16" if DEVICE_TYPE == "cuda" else "fp32")
+NUM_THREADS = int(os.environ.get("CLIP_NUM_THREADS", os.cpu_count() or 1))
+BENCHMARK = os.environ.get("CLIP_BENCHMARK", "1") == "1"
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+assert PRECISION in ["fp32", "fp16", "bf16", "int8"], f"Unknown precision {PRECISION}"
+assert not (
+    PRECISION == "int8" and DEVICE_TYPE != "cpu"
+), "int8 dynamic quantization is only supported on cpu"
+
+if DEVICE_TYPE == "cpu":
+    torch.set_num_threads(NUM_THREADS)
+    torch.set_num_interop_threads(max(1, NUM_THREADS // 4))
 
 (
     model,
@@ -24,39 +54,73 @@ DEVICE = "cuda"
     preprocess,
 ) = open_clip.create_model_and_transforms(CLIP_MODEL, pretrained=CLIP_DATASET)
 model = model.to(DEVICE).eval()
+if PRECISION == "int8":
+    model = torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
 tokenizer = open_clip.get_tokenizer(CLIP_MODEL)
 
 
-def get_image_embeddings(image_paths: List[str]) -> List[List[float]]:
-    for i in trange(0, len(image_paths), BATCH_SIZE):
-        batch = image_paths[i : i + BATCH_SIZE]
-        images = torch.stack(
-            [preprocess(Image.open(img).convert("RGB")) for img in batch]
-        ).to(DEVICE)
-        with torch.no_grad():
-            image_features = model.encode_image(images)
-            image_features = F.normalize(image_features, dim=-1)
+def inference_context():
+    if PRECISION in AUTOCAST_DTYPES:
+        return torch.autocast(device_type=DEVICE_TYPE, dtype=AUTOCAST_DTYPES[PRECISION])
+    return contextlib.nullcontext()
+
+
+class ImageDataset(Dataset):
+    def __init__(self, image_paths: List[str]):
+        self.image_paths = image_paths
+
+    def __len__(self) -> int:
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        return preprocess(Image.open(self.image_paths[idx]).convert("RGB"))
+
+
+def get_image_embeddings(image_paths: List[str]) -> np.ndarray:
+    """
+    Encode images while worker processes decode and preprocess the next batches,
+    writing every batch into a preallocated output array.
+    """
+    loader = DataLoader(
+        ImageDataset(image_paths),
+        batch_size=BATCH_SIZE,
+        # worker start-up is not worth it for a single batch
+        num_workers=NUM_WORKERS if len(image_paths) > BATCH_SIZE else 0,
+        pin_memory=DEVICE_TYPE == "cuda",
+    )
+    embeddings = None
+    offset = 0
+    for images in tqdm(loader):
+        with torch.inference_mode(), inference_context():
+            image_features = model.encode_image(images.to(DEVICE, non_blocking=True))
+            image_features = F.normalize(image_features.float(), dim=-1)
             image_features = image_features.cpu().numpy()
-            if i == 0:
-                embeddings = image_features
-            else:
-                embeddings = np.concatenate((embeddings, image_features))
-    return embeddings.tolist()
+        if embeddings is None:
+            embeddings = np.empty(
+                (len(image_paths), image_features.shape[1]), dtype=image_features.dtype
+            )
+        embeddings[offset : offset + len(image_features)] = image_features
+        offset += len(image_features)
+    return embeddings
 
 
-def get_text_embeddings(texts: List[str]) -> List[List[float]]:
+def get_text_embeddings(texts: List[str]) -> np.ndarray:
+    embeddings = None
     for i in trange(0, len(texts), BATCH_SIZE):
         batch = texts[i : i + BATCH_SIZE]
         text = tokenizer(batch).to(DEVICE)
-        with torch.no_grad():
+        with torch.inference_mode(), inference_context():
             text_features = model.encode_text(text)
-            text_features = F.normalize(text_features, dim=-1)
+            text_features = F.normalize(text_features.float(), dim=-1)
             text_features = text_features.cpu().numpy()
-            if i == 0:
-                embeddings = text_features
-            else:
-                embeddings = np.concatenate((embeddings, text_features))
-    return embeddings.tolist()
+        if embeddings is None:
+            embeddings = np.empty(
+                (len(texts), text_features.shape[1]), dtype=text_features.dtype
+            )
+        embeddings[i : i + len(text_features)] = text_features
+    return embeddings
 
 
 @app.route("/", methods=["POST"])
@@ -72,9 +136,63 @@ def interact_with_clip():
         logging.info(texts)
         embeddings = get_text_embeddings(texts)
 
-    return jsonify({"embeddings": embeddings})
+    # the response format is negotiated through the Accept header; JSON stays the
+    # default for clients that do not ask for a binary payload
+    mimetype = request.accept_mimetypes.best_match(RESPONSE_MIMETYPES)
+    if mimetype == "application/json" or mimetype is None:
+        return jsonify({"embeddings": embeddings.tolist()})
+
+    embeddings = embeddings.astype(request.form.get("dtype", RESPONSE_DTYPE))
+    if mimetype == "application/x-npy":
+        buffer = io.BytesIO()
+        np.save(buffer, embeddings)
+        data = buffer.getvalue()
+    else:
+        data = embeddings.tobytes()
+    return Response(
+        data,
+        mimetype=mimetype,
+        headers={
+            "X-Embedding-Shape": ",".join(str(dim) for dim in embeddings.shape),
+            "X-Embedding-Dtype": embeddings.dtype.name,
+        },
+    )
+
+
+def benchmark(n_images: int = 32, n_texts: int = 256):
+    """
+    Log the encoding throughput of the configured backend, so the fastest
+    CLIP_PRECISION/CLIP_NUM_THREADS can be picked per host.
+    """
+    image = preprocess(Image.new("RGB", (256, 256)))
+    images = image.unsqueeze(0).repeat(min(n_images, BATCH_SIZE), 1, 1, 1).to(DEVICE)
+    texts = tokenizer(["a photo of a dog"] * min(n_texts, BATCH_SIZE)).to(DEVICE)
+
+    with torch.inference_mode(), inference_context():
+        model.encode_image(images[:1])  # warm up
+        if DEVICE_TYPE == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        model.encode_image(images)
+        if DEVICE_TYPE == "cuda":
+            torch.cuda.synchronize()
+        image_throughput = len(images) / (time.time() - start)
+
+        start = time.time()
+        model.encode_text(texts)
+        if DEVICE_TYPE == "cuda":
+            torch.cuda.synchronize()
+        text_throughput = len(texts) / (time.time() - start)
+
+    threads = f", {torch.get_num_threads()} threads" if DEVICE_TYPE == "cpu" else ""
+    logging.info(
+        f"CLIP backend {DEVICE}/{PRECISION}{threads}: "
+        f"{image_throughput:.1f} images/s, {text_throughput:.1f} texts/s"
+    )
 
 
 if __name__ == "__main__":
+    if BENCHMARK:
+        benchmark()
     logging.info("Server is running!")
     app.run(host="0.0.0.0", port=8090, debug=False)
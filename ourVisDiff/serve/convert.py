@@ -1,21 +1,98 @@
+import argparse
+import glob
 import json
+import os
 
 import lmdb
 
-from serve.utils_general import save_to_cache
+from serve.global_vars import CLIP_CACHE_DTYPE, CLIP_CACHE_FILE
+from serve.utils_cache import ATIME_DB, LMDBCache, open_sharded_cache
+from serve.utils_general import encode_embedding, is_legacy_embedding, save_to_cache
 
 
 def jsonl_to_lmdb(jsonl_file: str, lmdb_file: str):
-    env = lmdb.open(lmdb_file, map_size=1e9)  # 1GB size, adjust if needed
+    cache = LMDBCache(lmdb_file, map_size=int(1e9))  # 1GB size, adjust if needed
     with open(jsonl_file, "r") as f:
         for line in f:
             item = json.loads(line)
             print(item["key"])
-            save_to_cache(item["key"], item["value"], env)
+            save_to_cache(item["key"], item["value"], cache)
+    cache.close()
+
+
+def print_cache_stats(root: str):
+    """
+    Print entries and bytes in use of every shard of a sharded cache.
+    """
+    cache = open_sharded_cache(root)
+    for shard_dir in sorted(glob.glob(os.path.join(root, "shards", "*"))):
+        cache.get_shard(os.path.basename(shard_dir))
+    for name, stats in cache.stats().items():
+        print(f"{name}: {stats['entries']} entries, {stats['bytes'] / 1e6:.1f}MB")
+
+
+def migrate_clip_cache(
+    lmdb_file: str = CLIP_CACHE_FILE,
+    dtype: str = CLIP_CACHE_DTYPE,
+    batch_size: int = 1000,
+):
+    """
+    Rewrite legacy JSON embeddings in a CLIP cache and all of its shards to the
+    binary format in place. Keys are kept, so entries stay addressable by the
+    same (input, model) pair.
+    """
+    shard_dirs = sorted(glob.glob(os.path.join(lmdb_file, "shards", "*")))
+    for path in [lmdb_file] + shard_dirs:
+        if os.path.exists(os.path.join(path, "data.mdb")):
+            migrate_embeddings(path, dtype, batch_size)
+
+
+def migrate_embeddings(lmdb_file: str, dtype: str, batch_size: int):
+    env = lmdb.open(lmdb_file, map_size=int(1e11), max_dbs=1)
+    n_migrated = 0
+    n_bytes_before = 0
+    n_bytes_after = 0
+    batch = []
+
+    def flush():
+        with env.begin(write=True) as txn:
+            for key, value in batch:
+                txn.put(key, value)
+        batch.clear()
+
+    with env.begin(write=False) as txn:
+        for key, value in txn.cursor():
+            if key == ATIME_DB or not is_legacy_embedding(value):
+                continue
+            new_value = encode_embedding(json.loads(value), dtype=dtype)
+            batch.append((key, new_value))
+            n_migrated += 1
+            n_bytes_before += len(value)
+            n_bytes_after += len(new_value)
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
     env.close()
+    print(
+        f"{lmdb_file}: migrated {n_migrated} embeddings to {dtype} "
+        f"({n_bytes_before / 1e6:.1f}MB -> {n_bytes_after / 1e6:.1f}MB)"
+    )
 
 
 if __name__ == "__main__":
-    jsonl_file = "cache_vlm2.jsonl"
-    lmdb_file = "cache/cache_vlm"
-    jsonl_to_lmdb(jsonl_file, lmdb_file)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--migrate-clip-cache", action="store_true")
+    parser.add_argument("--cache-stats", type=str, help="root of a sharded cache")
+    parser.add_argument("--clip-cache", type=str, default=CLIP_CACHE_FILE)
+    parser.add_argument("--dtype", type=str, default=CLIP_CACHE_DTYPE)
+    args = parser.parse_args()
+
+    if args.migrate_clip_cache:
+        migrate_clip_cache(args.clip_cache, args.dtype)
+    elif args.cache_stats:
+        print_cache_stats(args.cache_stats)
+    else:
+        jsonl_file = "cache_vlm2.jsonl"
+        lmdb_file = "cache/cache_vlm"
+        jsonl_to_lmdb(jsonl_file, lmdb_file)
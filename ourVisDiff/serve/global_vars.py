@@ -1,6 +1,12 @@
 # LLM API
 VICUNA_URL = "http://localhost:8000/v1"
 LLM_CACHE_FILE = "cache/cache_llm"
+LLM_MAX_CONCURRENCY = {  # maximum in-flight requests per model
+    "gpt-3.5-turbo": 16,
+    "gpt-4": 8,
+    "gpt-4o": 16,
+    "vicuna": 32,
+}
 
 # VLM API
 LLAVA_CODE_PATH = "./LLaVA"
@@ -8,7 +14,22 @@ BLIP_URL = "http://localhost:8082"
 LLAVA_URL = "http://localhost:8084"
 BLIP_FEATURE_URL = "http://localhost:8086"
 VLM_CACHE_FILE = "cache/cache_vlm"
+VLM_MAX_CONCURRENCY = {  # maximum in-flight requests per backend URL
+    BLIP_URL: 8,
+    LLAVA_URL: 4,
+    BLIP_FEATURE_URL: 1,
+    "gpt-4-vision-preview": 8,
+}
 
 # CLIP API
 CLIP_URL = "http://localhost:8090"
-CLIP_CACHE_FILE = "cache/cache_clip"
\ No newline at end of file
+CLIP_CACHE_FILE = "cache/cache_clip"
+CLIP_CACHE_DTYPE = "float16"  # dtype of embeddings stored in the CLIP cache
+
+# Image identity
+IMAGE_ID_CACHE_FILE = "cache/cache_image_id"  # (device, inode, mtime, size) -> content hash
+IMAGE_ID_CACHE_MAX_BYTES = int(1e9)
+
+# Cache eviction, applied to every per-model shard of the LLM, VLM and CLIP caches
+CACHE_SHARD_MAX_BYTES = int(20e9)  # least recently used entries are evicted beyond this
+CACHE_MAX_AGE_DAYS = None  # entries not read for this many days are dropped, None keeps them
@@ -0,0 +1,467 @@
+import atexit
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import lmdb
+
+from serve.global_vars import CACHE_MAX_AGE_DAYS, CACHE_SHARD_MAX_BYTES
+
+ATIME_DB = b"__atime__"  # named db holding the last access time of every key
+EXPIRED_AT_KEY = b"!expired_at"  # stored in ATIME_DB, last age-eviction run
+EXPIRE_INTERVAL = 3600  # seconds between two age-eviction scans of a shard
+TOUCH_BATCH_SIZE = 1000  # hits buffered before their access times are written
+LOW_WATERMARK = 0.9  # size eviction frees space down to this fraction of the limit
+EVICT_CHUNK_SIZE = 1000  # entries deleted between two size checks
+WRITE_BATCH_SIZE = 1000  # buffered writes that trigger a flush
+WRITE_BATCH_BYTES = int(64e6)  # buffered bytes that trigger a flush
+WRITE_INTERVAL = 5.0  # seconds after which buffered writes are flushed anyway
+
+
+class CacheBackend:
+    """
+    Key/value store behind get_from_cache and save_to_cache. Keys are the
+    already hashed cache keys.
+    """
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[bytes]]:
+        raise NotImplementedError
+
+    def put_many(self, items: Sequence[Tuple[bytes, bytes]]):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+
+class LMDBCache(CacheBackend):
+    """
+    One LMDB environment with an optional size limit (least recently used
+    entries are evicted first) and an optional maximum age since the last
+    access. Misses can fall back to another backend, whose hits are copied
+    into this one. The environment is opened lazily and closed around fork(),
+    so parent and forked workers each reopen their own handle.
+
+    With write_behind, put_many only buffers the items (reads see them right
+    away). Buffered writes and access times are committed together in one
+    transaction once WRITE_BATCH_SIZE items or WRITE_BATCH_BYTES are pending,
+    after WRITE_INTERVAL seconds, on flush() and at exit.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        fallback: Optional[CacheBackend] = None,
+        map_size: Optional[int] = None,
+        readonly: bool = False,
+        write_behind: bool = True,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fallback = fallback
+        self.map_size = map_size or (2 * max_bytes if max_bytes else int(1e11))
+        self.readonly = readonly
+        self.write_behind = write_behind
+        self.env = None
+        self.atime_db = None
+        # held for the whole of every transaction, so fork() never splits one
+        self.env_lock = threading.RLock()
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.pending = {}
+        self.pending_bytes = 0
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "evictions": 0,
+        }
+        register_cache(open_caches, self)
+
+    @contextmanager
+    def transaction(self, write: bool = False):
+        with self.env_lock:
+            if self.env is None:
+                self.open()
+            with self.env.begin(write=write) as txn:
+                yield txn
+
+    def open(self):
+        if self.readonly:
+            self.env = lmdb.open(self.path, readonly=True, max_dbs=1)
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self.env = lmdb.open(self.path, map_size=self.map_size, max_dbs=1)
+        self.atime_db = self.env.open_db(ATIME_DB)
+        if self.max_age is not None:
+            self.expire()
+
+    def close(self):
+        self.flush()
+        with self.env_lock:
+            if self.env is not None:
+                self.env.close()
+                self.env = None
+
+    def count(self, **increments):
+        with self.lock:
+            for name, increment in increments.items():
+                self.counters[name] += increment
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[bytes]]:
+        with self.lock:
+            found = {key: self.pending[key] for key in keys if key in self.pending}
+        stored_keys = sorted(set(keys) - found.keys())
+        if stored_keys:
+            with self.transaction() as txn:
+                found.update(txn.cursor().getmulti(stored_keys))
+        values = [found.get(key) or None for key in keys]
+
+        if self.fallback is not None:
+            missing = [key for key, value in zip(keys, values) if value is None]
+            if missing:
+                copied = {}
+                for key, value in zip(missing, self.fallback.get_many(missing)):
+                    if value is not None:
+                        copied[key] = value
+                self.put_many(list(copied.items()))
+                values = [
+                    value if value is not None else copied.get(key)
+                    for key, value in zip(keys, values)
+                ]
+
+        hits = [key for key, value in zip(keys, values) if value is not None]
+        self.count(
+            hits=len(hits),
+            misses=len(keys) - len(hits),
+            bytes_read=sum(len(value) for value in values if value is not None),
+        )
+        if self.readonly:
+            return values
+
+        now = pack_time(time.time())
+        with self.lock:
+            self.touched.update((key, now) for key in hits)
+            flush = len(self.touched) >= TOUCH_BATCH_SIZE
+        if flush:
+            self.flush()
+        return values
+
+    def put_many(self, items: Sequence[Tuple[bytes, bytes]]):
+        if self.readonly:
+            raise lmdb.ReadonlyError(f"Cache {self.path} is read-only")
+        if not items:
+            return
+        now = pack_time(time.time())
+        with self.lock:
+            for key, value in items:
+                self.pending_bytes += len(value) - len(self.pending.get(key, b""))
+                self.pending[key] = value
+                self.touched[key] = now
+            flush = (
+                not self.write_behind
+                or len(self.pending) >= WRITE_BATCH_SIZE
+                or self.pending_bytes >= WRITE_BATCH_BYTES
+            )
+        if flush:
+            self.flush()
+        else:
+            start_flusher()
+
+    def flush(self):
+        """
+        Commit buffered writes and access times in one transaction.
+        """
+        if self.readonly:
+            return
+        with self.env_lock:
+            with self.lock:
+                items, self.pending = self.pending, {}
+                touched, self.touched = self.touched, {}
+                self.pending_bytes = 0
+            if not items and not touched:
+                return
+            try:
+                self.write_or_evict(list(items.items()), touched)
+            except Exception:
+                self.restore(items, touched)
+                raise
+        self.count(bytes_written=sum(len(value) for value in items.values()))
+
+    def write_or_evict(
+        self, items: Sequence[Tuple[bytes, bytes]], touched: Dict[bytes, bytes]
+    ):
+        try:
+            self.write(items, touched)
+        except lmdb.MapFullError:
+            logging.warning(f"Cache {self.path} is full, evicting")
+            with self.transaction(write=True) as txn:
+                self.evict(txn, int(self.size(txn) * LOW_WATERMARK))
+            self.write(items, touched)
+
+    def restore(self, items: Dict[bytes, bytes], touched: Dict[bytes, bytes]):
+        """
+        Put writes back into the buffer after a failed commit, so they are
+        retried by the next flush. Newer writes of the same keys win.
+        """
+        with self.lock:
+            for key, value in items.items():
+                if key not in self.pending:
+                    self.pending[key] = value
+                    self.pending_bytes += len(value)
+            for key, atime in touched.items():
+                self.touched.setdefault(key, atime)
+
+    def write(self, items: Sequence[Tuple[bytes, bytes]], touched: Dict[bytes, bytes]):
+        with self.transaction(write=True) as txn:
+            if items:
+                txn.cursor().putmulti(sorted(items))
+            txn.cursor(db=self.atime_db).putmulti(sorted(touched.items()))
+            if self.max_bytes is not None and self.size(txn) > self.max_bytes:
+                self.evict(txn, int(self.max_bytes * LOW_WATERMARK))
+
+    def size(self, txn: lmdb.Transaction) -> int:
+        """
+        Bytes in use by entries and access times. Pages freed by eviction are
+        reused by LMDB, so the file stops growing at roughly max_bytes.
+        """
+        total = 0
+        for stat in [txn.stat(), txn.stat(self.atime_db)]:
+            pages = stat["branch_pages"] + stat["leaf_pages"] + stat["overflow_pages"]
+            total += pages * stat["psize"]
+        return total
+
+    def evict(self, txn: lmdb.Transaction, target_bytes: int):
+        """
+        Delete least recently used entries until the size is below target_bytes.
+        Entries without an access time (written before eviction existed) go first.
+        """
+        atimes = dict(txn.cursor(db=self.atime_db))
+        keys = [key for key in txn.cursor().iternext(values=False) if key != ATIME_DB]
+        # access times of keys evicted by another process after they were read
+        for key in atimes.keys() - set(keys) - {EXPIRED_AT_KEY}:
+            txn.delete(key, db=self.atime_db)
+        keys.sort(key=lambda key: atimes.get(key, b""))
+
+        n_evicted = 0
+        for start in range(0, len(keys), EVICT_CHUNK_SIZE):
+            if self.size(txn) <= target_bytes:
+                break
+            for key in keys[start : start + EVICT_CHUNK_SIZE]:
+                txn.delete(key)
+                txn.delete(key, db=self.atime_db)
+                n_evicted += 1
+        self.count(evictions=n_evicted)
+        logging.info(f"Evicted {n_evicted} entries from cache {self.path}")
+
+    def expire(self):
+        """
+        Delete entries not accessed for max_age seconds, at most once per
+        EXPIRE_INTERVAL across all processes. Entries without an access time
+        start their clock now instead of being dropped.
+        """
+        now = time.time()
+        with self.transaction(write=True) as txn:
+            expired_at = txn.get(EXPIRED_AT_KEY, db=self.atime_db)
+            if expired_at is not None:
+                if now - unpack_time(expired_at) < EXPIRE_INTERVAL:
+                    return
+
+            atimes = dict(txn.cursor(db=self.atime_db))
+            cutoff = pack_time(now - self.max_age)
+            n_expired = 0
+            for key in list(txn.cursor().iternext(values=False)):
+                if key == ATIME_DB:
+                    continue
+                if key not in atimes:
+                    txn.put(key, pack_time(now), db=self.atime_db)
+                elif atimes[key] < cutoff:
+                    txn.delete(key)
+                    txn.delete(key, db=self.atime_db)
+                    n_expired += 1
+            txn.put(EXPIRED_AT_KEY, pack_time(now), db=self.atime_db)
+        self.count(evictions=n_expired)
+        if n_expired > 0:
+            logging.info(f"Expired {n_expired} entries from cache {self.path}")
+
+    def stats(self) -> Dict:
+        with self.transaction() as txn:
+            n_entries = txn.stat()["entries"]
+            size = self.size(txn) if not self.readonly else None
+        if not self.readonly:
+            n_entries -= 1  # the ATIME_DB record
+        with self.lock:
+            return dict(
+                self.counters, entries=n_entries, bytes=size, pending=len(self.pending)
+            )
+
+
+class ShardedCache:
+    """
+    A directory of LMDBCache shards, one per model, each with its own size limit.
+    A cache written before sharding (an LMDB environment in the root directory
+    itself) is used read-only as fallback by every shard.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes_per_shard: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ):
+        self.root = root
+        self.max_bytes_per_shard = max_bytes_per_shard
+        self.max_age = max_age
+        self.shards = {}
+        self.lock = threading.Lock()
+        self.legacy = None
+        register_cache(sharded_caches, self)
+
+    def get_shard(self, name: str) -> LMDBCache:
+        with self.lock:
+            if not self.shards and os.path.exists(os.path.join(self.root, "data.mdb")):
+                self.legacy = LMDBCache(self.root, readonly=True)
+            if name not in self.shards:
+                shard_name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+                self.shards[name] = LMDBCache(
+                    os.path.join(self.root, "shards", shard_name),
+                    max_bytes=self.max_bytes_per_shard,
+                    max_age=self.max_age,
+                    fallback=self.legacy,
+                )
+            return self.shards[name]
+
+    def flush(self):
+        with self.lock:
+            shards = list(self.shards.values())
+        for shard in shards:
+            shard.flush()
+
+    def stats(self) -> Dict[str, Dict]:
+        with self.lock:
+            shards = dict(self.shards)
+        return {name: shard.stats() for name, shard in shards.items()}
+
+
+def open_sharded_cache(root: str) -> ShardedCache:
+    """
+    ShardedCache with the eviction settings of global_vars.
+    """
+    max_age = CACHE_MAX_AGE_DAYS * 86400 if CACHE_MAX_AGE_DAYS is not None else None
+    return ShardedCache(root, CACHE_SHARD_MAX_BYTES, max_age)
+
+
+def pack_time(timestamp: float) -> bytes:
+    # big-endian, so byte order is time order
+    return struct.pack(">d", timestamp)
+
+
+def unpack_time(value: bytes) -> float:
+    return struct.unpack(">d", value)[0]
+
+
+# caches of this process, for flush_caches and the fork hooks. Caches may be
+# created on any thread, so the sets are only changed and read under a lock.
+open_caches = weakref.WeakSet()
+sharded_caches = weakref.WeakSet()
+registry_lock = threading.Lock()
+
+
+def register_cache(caches: weakref.WeakSet, cache):
+    with registry_lock:
+        caches.add(cache)
+
+
+def get_caches(caches: weakref.WeakSet) -> List:
+    with registry_lock:
+        return list(caches)
+
+
+def flush_caches():
+    """
+    Commit the buffered writes of every cache in this process.
+    """
+    for cache in get_caches(open_caches):
+        try:
+            cache.flush()
+        except Exception as e:
+            logging.error(f"Cache flush of {cache.path} failed: {e}")
+
+
+atexit.register(flush_caches)
+
+# one daemon thread per process flushes writes older than WRITE_INTERVAL
+flusher_pid = None
+flusher_lock = threading.Lock()
+
+
+def start_flusher():
+    global flusher_pid
+    with flusher_lock:
+        if flusher_pid == os.getpid():
+            return
+        flusher_pid = os.getpid()
+
+    def flush_periodically():
+        while True:
+            time.sleep(WRITE_INTERVAL)
+            flush_caches()
+
+    threading.Thread(target=flush_periodically, daemon=True).start()
+
+
+# An LMDB handle must not be used in a forked child, and closing the inherited
+# handle there would clear the parent's reader slots. So every cache is flushed
+# and closed right before fork() (waiting for running transactions) and reopened
+# lazily on both sides. All cache locks are held across fork(), always taken in
+# the same order (env_lock, then lock), so the child never inherits a lock that
+# a thread of the parent was holding.
+forking_caches = []
+forking_locks = []
+
+
+def close_before_fork():
+    flush_caches()
+    forking_caches.extend(get_caches(open_caches))
+    for cache in forking_caches:
+        cache.env_lock.acquire()
+        if cache.env is not None:
+            cache.env.close()
+            cache.env = None
+    forking_locks.extend(cache.lock for cache in forking_caches)
+    forking_locks.extend(cache.lock for cache in get_caches(sharded_caches))
+    forking_locks.append(flusher_lock)
+    # last, as get_shard creates caches while holding its ShardedCache.lock
+    forking_locks.append(registry_lock)
+    for lock in forking_locks:
+        lock.acquire()
+
+
+def release_after_fork():
+    for lock in reversed(forking_locks):
+        lock.release()
+    for cache in forking_caches:
+        cache.env_lock.release()
+    forking_locks.clear()
+    forking_caches.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=close_before_fork,
+        after_in_parent=release_after_fork,
+        after_in_child=release_after_fork,
+    )
@@ -1,48 +1,97 @@
 import json
 import logging
-import os
 from typing import List
 
-import lmdb
 import numpy as np
 import requests
 
-from serve.global_vars import CLIP_CACHE_FILE, CLIP_URL
-from serve.utils_general import get_from_cache, save_to_cache
+from serve.global_vars import CLIP_CACHE_DTYPE, CLIP_CACHE_FILE, CLIP_URL
+from serve.utils_cache import open_sharded_cache
+from serve.utils_general import (
+    decode_embedding,
+    encode_embedding,
+    get_image_ids,
+    get_many_bytes_from_cache,
+    save_many_bytes_to_cache,
+)
 
-if not os.path.exists(CLIP_CACHE_FILE):
-    os.makedirs(CLIP_CACHE_FILE)
+clip_cache = open_sharded_cache(CLIP_CACHE_FILE)  # one shard per CLIP model
 
-clip_cache = lmdb.open(CLIP_CACHE_FILE, map_size=int(1e11))
+
+def decode_response(response: requests.Response) -> np.ndarray:
+    """
+    Decode the embeddings of a CLIP server response. Binary payloads are viewed
+    in place with np.frombuffer, older servers answer with JSON.
+    """
+    if response.headers.get("Content-Type", "").startswith("application/octet-stream"):
+        shape = tuple(
+            int(dim) for dim in response.headers["X-Embedding-Shape"].split(",")
+        )
+        dtype = np.dtype(response.headers["X-Embedding-Dtype"])
+        return np.frombuffer(response.content, dtype=dtype).reshape(shape)
+    return np.asarray(response.json()["embeddings"], dtype=np.float32)
 
 
 def get_embeddings(inputs: List[str], model: str, modality: str) -> np.ndarray:
     input_to_embeddings = {}
-    for inp in inputs:
-        key = json.dumps([inp, model])
-        cached_value = get_from_cache(key, clip_cache)
+    cache = clip_cache.get_shard(model)
+    legacy_keys = [json.dumps([inp, model]) for inp in inputs]
+    if modality == "image":
+        # images are keyed on their content, path keys are only read as fallback
+        keys = [json.dumps([image_id, model]) for image_id in get_image_ids(inputs)]
+    else:
+        keys = legacy_keys
+    input_to_key = dict(zip(inputs, keys))
+    cached_values = get_many_bytes_from_cache(keys, cache, legacy_keys)
+    for inp, cached_value in zip(inputs, cached_values):
         if cached_value is not None:
             logging.debug(f"CLIP Cache Hit")
-            input_to_embeddings[inp] = json.loads(cached_value)
+            input_to_embeddings[inp] = decode_embedding(cached_value)
 
-    uncached_inputs = [inp for inp in inputs if inp not in input_to_embeddings]
+    uncached_inputs = list(
+        dict.fromkeys(inp for inp in inputs if inp not in input_to_embeddings)
+    )
 
     if len(uncached_inputs) > 0:
         try:
             response = requests.post(
-                CLIP_URL, data={modality: json.dumps(uncached_inputs)}
-            ).json()
-            for inp, embedding in zip(uncached_inputs, response["embeddings"]):
+                CLIP_URL,
+                data={modality: json.dumps(uncached_inputs), "dtype": CLIP_CACHE_DTYPE},
+                headers={"Accept": "application/octet-stream, application/json;q=0.5"},
+            )
+            for inp, embedding in zip(uncached_inputs, decode_response(response)):
                 input_to_embeddings[inp] = embedding
-                key = json.dumps([inp, model])
-                save_to_cache(key, json.dumps(embedding), clip_cache)
         except Exception as e:
             logging.error(f"CLIP Error: {e}")
             for inp in uncached_inputs:
                 input_to_embeddings[inp] = None
+        else:
+            # the embeddings are valid even if they cannot be cached
+            try:
+                save_many_bytes_to_cache(
+                    [input_to_key[inp] for inp in uncached_inputs],
+                    [
+                        encode_embedding(input_to_embeddings[inp])
+                        for inp in uncached_inputs
+                    ],
+                    cache,
+                )
+            except Exception as e:
+                logging.error(f"CLIP cache write failed: {e}")
 
     input_embeddings = [input_to_embeddings[inp] for inp in inputs]
-    return np.array(input_embeddings)
+    if any(embedding is None for embedding in input_embeddings):
+        return np.array(input_embeddings, dtype=object)
+    if len(input_embeddings) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    # cast the (possibly float16) cached views straight into one float32 matrix
+    embeddings = np.empty(
+        (len(input_embeddings), input_embeddings[0].shape[-1]), dtype=np.float32
+    )
+    for i, embedding in enumerate(input_embeddings):
+        embeddings[i] = embedding
+    return embeddings
 
 
 if __name__ == "__main__":
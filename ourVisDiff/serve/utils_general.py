@@ -1,9 +1,40 @@
+import functools
 import hashlib
-from typing import Dict, List, Optional
+import json
+import os
+from typing import Dict, List, Optional, Sequence
 
-import lmdb
+import numpy as np
 from PIL import Image
 
+from serve.global_vars import (
+    CLIP_CACHE_DTYPE,
+    IMAGE_ID_CACHE_FILE,
+    IMAGE_ID_CACHE_MAX_BYTES,
+)
+from serve.utils_cache import CacheBackend, LMDBCache
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    """
+    Import the OpenAI client and set its API key on first use, so the serve
+    utilities can be imported without OPENAI_API_KEY.
+    """
+    import openai
+
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    return openai
+
+
+def check_openai_key(model: str):
+    """
+    Fail fast instead of retrying every request into an authentication error.
+    Only OpenAI models need the key, self-hosted vLLM servers accept any key.
+    """
+    if not os.environ.get("OPENAI_API_KEY"):
+        raise RuntimeError(f"OPENAI_API_KEY must be set to use {model}")
+
 
 def resize_image(image: Image.Image, size=(256, 256)) -> Image.Image:
     return image.resize(size)
@@ -79,16 +110,164 @@ def hash_key(key) -> str:
     return hashlib.sha256(key.encode()).hexdigest()
 
 
-def get_from_cache(key: str, env: lmdb.Environment) -> Optional[str]:
-    with env.begin(write=False) as txn:
-        hashed_key = hash_key(key)
-        value = txn.get(hashed_key.encode())
+def get_bytes_from_cache(key: str, cache: CacheBackend) -> Optional[bytes]:
+    return cache.get_many([hash_key(key).encode()])[0]
+
+
+def save_bytes_to_cache(key: str, value: bytes, cache: CacheBackend):
+    cache.put_many([(hash_key(key).encode(), value)])
+
+
+def get_from_cache(key: str, cache: CacheBackend) -> Optional[str]:
+    value = get_bytes_from_cache(key, cache)
     if value:
         return value.decode()
     return None
 
 
-def save_to_cache(key: str, value: str, env: lmdb.Environment):
-    with env.begin(write=True) as txn:
-        hashed_key = hash_key(key)
-        txn.put(hashed_key.encode(), value.encode())
+def save_to_cache(key: str, value: str, cache: CacheBackend):
+    save_bytes_to_cache(key, value.encode(), cache)
+
+
+def get_many_bytes_from_cache(
+    keys: Sequence[str],
+    cache: CacheBackend,
+    legacy_keys: Optional[Sequence[str]] = None,
+) -> List[Optional[bytes]]:
+    """
+    Look up all keys in one call to the backend. Keys that miss are retried
+    under their legacy_keys entry, and values found that way are copied over
+    to the new key.
+    """
+    hashed_keys = [hash_key(key).encode() for key in keys]
+    values = cache.get_many(hashed_keys)
+    if legacy_keys is None:
+        return values
+
+    missing = {}  # hashed legacy key -> positions of the keys that map to it
+    for i, legacy_key in enumerate(legacy_keys):
+        if values[i] is None and legacy_key != keys[i]:
+            missing.setdefault(hash_key(legacy_key).encode(), []).append(i)
+    if not missing:
+        return values
+    migrated = {}
+    for hashed_legacy_key, value in zip(missing, cache.get_many(list(missing))):
+        if value is not None:
+            for i in missing[hashed_legacy_key]:
+                values[i] = value
+                migrated[hashed_keys[i]] = value
+    cache.put_many(list(migrated.items()))
+    return values
+
+
+def save_many_bytes_to_cache(
+    keys: Sequence[str], values: Sequence[bytes], cache: CacheBackend
+):
+    """
+    Write all key/value pairs in one call to the backend.
+    """
+    items = [(hash_key(key).encode(), value) for key, value in zip(keys, values)]
+    if not items:
+        return
+    cache.put_many(items)
+
+
+def get_many_from_cache(
+    keys: Sequence[str],
+    cache: CacheBackend,
+    legacy_keys: Optional[Sequence[str]] = None,
+) -> List[Optional[str]]:
+    return [
+        value.decode() if value is not None else None
+        for value in get_many_bytes_from_cache(keys, cache, legacy_keys)
+    ]
+
+
+def save_many_to_cache(
+    keys: Sequence[str], values: Sequence[str], cache: CacheBackend
+):
+    save_many_bytes_to_cache(keys, [value.encode() for value in values], cache)
+
+
+image_id_cache = LMDBCache(IMAGE_ID_CACHE_FILE, max_bytes=IMAGE_ID_CACHE_MAX_BYTES)
+image_id_memo = {}
+
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_image_ids(paths: Sequence[str]) -> List[str]:
+    """
+    Content-addressed identities of image files, used in cache keys instead of
+    the path, so the same image reached through different relative paths or
+    working directories shares its cache entries. Hashes are memoized on
+    (device, inode, mtime, size) in memory and in IMAGE_ID_CACHE_FILE, so a file
+    is only read again after it changed. Paths that do not exist keep the path
+    itself as identity.
+    """
+    stat_keys = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stat_keys.append(
+                f"{stat.st_dev}:{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}"
+            )
+        except OSError:
+            stat_keys.append(None)
+
+    unknown = [
+        stat_key
+        for stat_key in dict.fromkeys(stat_keys)
+        if stat_key is not None and stat_key not in image_id_memo
+    ]
+    if unknown:
+        stat_key_to_path = dict(zip(stat_keys, paths))
+        new_ids = {}
+        for stat_key, image_id in zip(
+            unknown, get_many_from_cache(unknown, image_id_cache)
+        ):
+            if image_id is None:
+                image_id = "sha256:" + hash_file(stat_key_to_path[stat_key])
+                new_ids[stat_key] = image_id
+            image_id_memo[stat_key] = image_id
+        save_many_to_cache(list(new_ids.keys()), list(new_ids.values()), image_id_cache)
+
+    return [
+        image_id_memo[stat_key] if stat_key is not None else path
+        for path, stat_key in zip(paths, stat_keys)
+    ]
+
+
+def get_image_id(path: str) -> str:
+    return get_image_ids([path])[0]
+
+
+# Binary cache entries are EMBEDDING_MAGIC + numpy dtype char + raw buffer.
+# Legacy entries are JSON lists and therefore always start with "[".
+EMBEDDING_MAGIC = b"EMB"
+EMBEDDING_HEADER_SIZE = len(EMBEDDING_MAGIC) + 1
+
+
+def encode_embedding(embedding, dtype: str = CLIP_CACHE_DTYPE) -> bytes:
+    array = np.asarray(embedding, dtype=dtype)
+    return EMBEDDING_MAGIC + array.dtype.char.encode() + array.tobytes()
+
+
+def decode_embedding(value: bytes) -> np.ndarray:
+    """
+    Decode a cached embedding. Binary entries are returned as a read-only
+    zero-copy view over the cached buffer, legacy JSON entries are parsed.
+    """
+    if value.startswith(EMBEDDING_MAGIC):
+        dtype = np.dtype(chr(value[len(EMBEDDING_MAGIC)]))
+        return np.frombuffer(value, dtype=dtype, offset=EMBEDDING_HEADER_SIZE)
+    return np.asarray(json.loads(value), dtype=np.float32)
+
+
+def is_legacy_embedding(value: bytes) -> bool:
+    return value.lstrip().startswith(b"[")
@@ -1,70 +1,149 @@
 import json
 import logging
-import os
 import threading
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from serve.global_vars import LLM_CACHE_FILE, LLM_MAX_CONCURRENCY, VICUNA_URL
+from serve.utils_cache import open_sharded_cache
+from serve.utils_general import (
+    check_openai_key,
+    get_from_cache,
+    get_many_from_cache,
+    get_openai,
+    save_many_to_cache,
+    save_to_cache,
+)
 
-import lmdb
-import openai
+logging.basicConfig(level=logging.INFO)
 
-from serve.global_vars import LLM_CACHE_FILE, VICUNA_URL
-from serve.utils_general import get_from_cache, save_to_cache
+llm_cache = open_sharded_cache(LLM_CACHE_FILE)  # one shard per LLM
 
-logging.basicConfig(level=logging.INFO)
+LLM_ERROR = "LLM Error: Cannot get response."
+OPENAI_MODELS = ["gpt-3.5-turbo", "gpt-4", "gpt-4o"]
 
-if not os.path.exists(LLM_CACHE_FILE):
-    os.makedirs(LLM_CACHE_FILE)
+# one semaphore per model bounds the in-flight requests across all threads
+model_semaphores = {}
+model_semaphores_lock = threading.Lock()
 
-llm_cache = lmdb.open(LLM_CACHE_FILE, map_size=int(1e11))
-openai.api_key = os.environ["OPENAI_API_KEY"]
 
+def get_model_semaphore(model: str) -> threading.BoundedSemaphore:
+    with model_semaphores_lock:
+        if model not in model_semaphores:
+            model_semaphores[model] = threading.BoundedSemaphore(
+                LLM_MAX_CONCURRENCY.get(model, 1)
+            )
+        return model_semaphores[model]
 
-def get_llm_output(prompt: str, model: str) -> str:
-    api_base = {
-        "gpt-3.5-turbo": "https://api.openai.com/v1",
-        "gpt-4": "https://api.openai.com/v1",
-        "gpt-4o": "https://api.openai.com/v1",
-        "vicuna": VICUNA_URL,
-    }
-    openai.api_base = api_base[model]
 
-    if model in ["gpt-3.5-turbo", "gpt-4", "gpt-4o"]:
-        messages = [
+def get_llm_messages(prompt: str, model: str):
+    if model in OPENAI_MODELS:
+        return [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt},
         ]
-    else:
-        messages = prompt
-    key = json.dumps([model, messages])
+    return prompt
 
-    cached_value = get_from_cache(key, llm_cache)
-    if cached_value is not None:
-        logging.debug(f"LLM Cache Hit")
-        return cached_value
+
+def query_llm(prompt: str, model: str) -> Optional[str]:
+    """
+    Send a prompt to the LLM without touching the cache. Returns None if all
+    retries fail.
+    """
+    api_base = {
+        "gpt-3.5-turbo": "https://api.openai.com/v1",
+        "gpt-4": "https://api.openai.com/v1",
+        "gpt-4o": "https://api.openai.com/v1",
+        "vicuna": VICUNA_URL,
+    }[model]  # passed per request so concurrent requests to other models do not race
+    messages = get_llm_messages(prompt, model)
+    if model in OPENAI_MODELS:
+        check_openai_key(model)
 
     for _ in range(3):
         try:
-            if model in ["gpt-3.5-turbo", "gpt-4",  "gpt-4o"]:
-                completion = openai.ChatCompletion.create(
-                    model=model,
-                    messages=messages,
-                )
-                response = completion["choices"][0]["message"]["content"]
-            elif model == "vicuna":
-                completion = openai.Completion.create(
-                    model="lmsys/vicuna-7b-v1.5",
-                    prompt=prompt,
-                    max_tokens=256,
-                    temperature=0,  # TODO: greedy may not be optimal
-                )
-                response = completion["choices"][0]["text"]
-            save_to_cache(key, response, llm_cache)
+            with get_model_semaphore(model):
+                if model in OPENAI_MODELS:
+                    completion = get_openai().ChatCompletion.create(
+                        model=model,
+                        messages=messages,
+                        api_base=api_base,
+                    )
+                    response = completion["choices"][0]["message"]["content"]
+                elif model == "vicuna":
+                    completion = get_openai().Completion.create(
+                        model="lmsys/vicuna-7b-v1.5",
+                        prompt=prompt,
+                        max_tokens=256,
+                        temperature=0,  # TODO: greedy may not be optimal
+                        api_base=api_base,
+                        api_key="EMPTY",  # vLLM accepts any key
+                    )
+                    response = completion["choices"][0]["text"]
             return response
 
         except Exception as e:
             logging.error(f"LLM Error: {e}")
             continue
-    return "LLM Error: Cannot get response."
+    return None
+
+
+def get_llm_output(prompt: str, model: str) -> str:
+    key = json.dumps([model, get_llm_messages(prompt, model)])
+
+    cached_value = get_from_cache(key, llm_cache.get_shard(model))
+    if cached_value is not None:
+        logging.debug(f"LLM Cache Hit")
+        return cached_value
+
+    response = query_llm(prompt, model)
+    if response is None:
+        return LLM_ERROR
+    save_to_cache(key, response, llm_cache.get_shard(model))
+    return response
+
+
+def get_llm_outputs(
+    prompts: List[str], model: str, max_concurrency: Optional[int] = None
+) -> List[str]:
+    """
+    Batched get_llm_output. Cached prompts are resolved in one read transaction,
+    the remaining unique prompts are sent concurrently (at most max_concurrency
+    at a time, and never more than LLM_MAX_CONCURRENCY[model] across threads)
+    and written back in one transaction. Outputs are in the order of prompts.
+    """
+    keys = [json.dumps([model, get_llm_messages(prompt, model)]) for prompt in prompts]
+    outputs = get_many_from_cache(keys, llm_cache.get_shard(model))
+
+    key_to_prompt = {}
+    for prompt, key, output in zip(prompts, keys, outputs):
+        if output is None and key not in key_to_prompt:
+            key_to_prompt[key] = prompt
+
+    key_to_response = {}
+    if len(key_to_prompt) > 0:
+        if max_concurrency is None:
+            max_concurrency = LLM_MAX_CONCURRENCY.get(model, 1)
+        n_workers = max(1, min(max_concurrency, len(key_to_prompt)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            responses = executor.map(
+                lambda prompt: query_llm(prompt, model), key_to_prompt.values()
+            )
+            key_to_response = dict(zip(key_to_prompt.keys(), responses))
+
+    new_items = {
+        key: response
+        for key, response in key_to_response.items()
+        if response is not None
+    }
+    save_many_to_cache(
+        list(new_items.keys()), list(new_items.values()), llm_cache.get_shard(model)
+    )
+
+    return [
+        output if output is not None else key_to_response[key] or LLM_ERROR
+        for key, output in zip(keys, outputs)
+    ]
 
 
 def prompt_differences(captions1: List[str], captions2: List[str]) -> str:
@@ -131,6 +210,13 @@ def test_get_llm_output_parallel():
         thread.join()
 
 
+def test_get_llm_outputs():
+    prompts = ["hello", "how are you?", "hello"]
+    model = "gpt-3.5-turbo"
+    completions = get_llm_outputs(prompts, model, max_concurrency=2)
+    print(f"{model=}, {completions=}")
+
+
 def test_get_differences():
     captions1 = [
         "A cat is sitting on a table",
@@ -149,4 +235,5 @@ def test_get_differences():
 if __name__ == "__main__":
     test_get_llm_output()
     test_get_llm_output_parallel()
+    test_get_llm_outputs()
     test_get_differences()
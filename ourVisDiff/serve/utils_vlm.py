@@ -5,42 +5,87 @@ import base64
 
 logging.basicConfig(level=logging.INFO)
 
-import os
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-import lmdb
 import requests
-import openai
+from requests.adapters import HTTPAdapter
 
-from serve.global_vars import BLIP_FEATURE_URL, BLIP_URL, LLAVA_URL, VLM_CACHE_FILE
-from serve.utils_general import get_from_cache, save_to_cache
+from serve.global_vars import (
+    BLIP_FEATURE_URL,
+    BLIP_URL,
+    LLAVA_URL,
+    VLM_CACHE_FILE,
+    VLM_MAX_CONCURRENCY,
+)
+from serve.utils_cache import open_sharded_cache
+from serve.utils_general import (
+    check_openai_key,
+    get_image_id,
+    get_image_ids,
+    get_many_from_cache,
+    get_openai,
+    save_many_to_cache,
+    save_to_cache,
+)
 
-if not os.path.exists(VLM_CACHE_FILE):
-    os.makedirs(VLM_CACHE_FILE)
+vlm_cache = open_sharded_cache(VLM_CACHE_FILE)  # one shard per VLM
+
+VLM_ERROR = "VLM Error: Cannot get response."
+
+# one keep-alive session and one semaphore per backend, shared by all threads
+backend_sessions = {}
+backend_semaphores = {}
+backends_lock = threading.Lock()
+
+
+def get_backend(url: str):
+    """
+    Return the pooled session and the in-flight request semaphore of a backend.
+    """
+    with backends_lock:
+        if url not in backend_sessions:
+            max_concurrency = VLM_MAX_CONCURRENCY.get(url, 4)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            backend_sessions[url] = session
+            backend_semaphores[url] = threading.BoundedSemaphore(max_concurrency)
+        return backend_sessions[url], backend_semaphores[url]
 
-vlm_cache = lmdb.open(VLM_CACHE_FILE, map_size=int(1e11))
-openai.api_key = os.environ["OPENAI_API_KEY"]
 
 def get_embed_caption_blip(
     sampled_dataset1: List[Dict], sampled_dataset2: List[Dict]
 ) -> List[str]:
-    key = json.dumps([sampled_dataset1, sampled_dataset2, 1])
-    cached_value = get_from_cache(key, vlm_cache)
+    key = json.dumps(
+        [
+            get_image_ids([item["path"] for item in sampled_dataset1]),
+            get_image_ids([item["path"] for item in sampled_dataset2]),
+            1,
+        ]
+    )
+    legacy_key = json.dumps([sampled_dataset1, sampled_dataset2, 1])
+    cached_value = get_many_from_cache(
+        [key], vlm_cache.get_shard("blip_feature"), [legacy_key]
+    )[0]
     if cached_value is not None:
         logging.debug(f"VLM Cache Hit")
         cached_value = json.loads(cached_value)
         return cached_value
 
+    session, semaphore = get_backend(BLIP_FEATURE_URL)
     try:
-        response = requests.post(
-            BLIP_FEATURE_URL,
-            data={
-                "dataset1": json.dumps(sampled_dataset1),
-                "dataset2": json.dumps(sampled_dataset2),
-            },
-        ).json()
+        with semaphore:
+            response = session.post(
+                BLIP_FEATURE_URL,
+                data={
+                    "dataset1": json.dumps(sampled_dataset1),
+                    "dataset2": json.dumps(sampled_dataset2),
+                },
+            ).json()
         output = response["output"]
-        save_to_cache(key, json.dumps(output), vlm_cache)
+        save_to_cache(key, json.dumps(output), vlm_cache.get_shard("blip_feature"))
         return output
     except Exception as e:
         logging.error(f"VLM Error: {e}")
@@ -50,31 +95,31 @@ def get_image_base64(image_path):
     with open(image_path, 'rb') as file:
         return base64.b64encode(file.read()).decode('utf-8')
 
-def get_vlm_output(image: str, prompt: str, model: str) -> str:
-    key = json.dumps([model, image, prompt])
-    cached_value = get_from_cache(key, vlm_cache)
-    if cached_value is not None:
-        logging.debug(f"VLM Cache Hit")
-        return cached_value
-
+def query_vlm(image: str, prompt: str, model: str) -> Optional[str]:
+    """
+    Send one image and prompt to the VLM without touching the cache. Returns
+    None if the request fails.
+    """
     if model in ["blip", "llava"]:
-        files = {"image": open(image, "rb").read()}
         text_data = {"text": prompt}
         url = {
             "blip": BLIP_URL,
             "llava": LLAVA_URL,
         }[model]
+        session, semaphore = get_backend(url)
 
         try:
-            response = requests.post(url, data=text_data, files=files).json()
-            output = response["output"]
-            save_to_cache(key, output, vlm_cache)
-            return output
+            with semaphore, open(image, "rb") as f:
+                response = session.post(
+                    url, data=text_data, files={"image": f}
+                ).json()
+            return response["output"]
         except Exception as e:
             logging.error(f"VLM Error: {e}")
-            return "VLM Error: Cannot get response."
+            return None
 
     elif model == "gpt-4-vision-preview":  # Add GPT-4V support
+        check_openai_key(model)
         base64_image = get_image_base64(image)
         payload = {
             "model": "gpt-4-vision-preview",
@@ -90,18 +135,75 @@ def get_vlm_output(image: str, prompt: str, model: str) -> str:
             "max_tokens": 300
         }
 
+        _, semaphore = get_backend(model)
         try:
-            completion = openai.ChatCompletion.create(**payload)
-            response = completion["choices"][0]["message"]["content"]
-            save_to_cache(key, response, vlm_cache)
-            return response
+            with semaphore:
+                completion = get_openai().ChatCompletion.create(**payload)
+            return completion["choices"][0]["message"]["content"]
         except Exception as e:
             logging.error(f"VLM Error: {e}")
-            return "VLM Error: Cannot get response."
+            return None
     else:
         raise NotImplementedError(f"VLM model {model} not implemented.")
 
 
+def get_vlm_output(image: str, prompt: str, model: str) -> str:
+    key = json.dumps([model, get_image_id(image), prompt])
+    legacy_key = json.dumps([model, image, prompt])
+    cache = vlm_cache.get_shard(model)
+    cached_value = get_many_from_cache([key], cache, [legacy_key])[0]
+    if cached_value is not None:
+        logging.debug(f"VLM Cache Hit")
+        return cached_value
+
+    output = query_vlm(image, prompt, model)
+    if output is None:
+        return VLM_ERROR
+    save_to_cache(key, output, cache)
+    return output
+
+
+def get_vlm_outputs(
+    images: List[str], prompt: str, model: str, max_concurrency: Optional[int] = None
+) -> List[str]:
+    """
+    Batched get_vlm_output. Cached images are resolved in one read transaction,
+    the remaining unique images are sent concurrently (bounded per backend by
+    VLM_MAX_CONCURRENCY) and written back in one transaction. Outputs are in
+    the order of images.
+    """
+    keys = [json.dumps([model, image_id, prompt]) for image_id in get_image_ids(images)]
+    legacy_keys = [json.dumps([model, image, prompt]) for image in images]
+    outputs = get_many_from_cache(keys, vlm_cache.get_shard(model), legacy_keys)
+
+    key_to_image = {}
+    for image, key, output in zip(images, keys, outputs):
+        if output is None and key not in key_to_image:
+            key_to_image[key] = image
+
+    key_to_output = {}
+    if len(key_to_image) > 0:
+        if max_concurrency is None:
+            url = {"blip": BLIP_URL, "llava": LLAVA_URL}.get(model, model)
+            max_concurrency = VLM_MAX_CONCURRENCY.get(url, 4)
+        n_workers = max(1, min(max_concurrency, len(key_to_image)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            new_outputs = executor.map(
+                lambda image: query_vlm(image, prompt, model), key_to_image.values()
+            )
+            key_to_output = dict(zip(key_to_image.keys(), new_outputs))
+
+    new_items = {key: output for key, output in key_to_output.items() if output is not None}
+    save_many_to_cache(
+        list(new_items.keys()), list(new_items.values()), vlm_cache.get_shard(model)
+    )
+
+    return [
+        output if output is not None else key_to_output[key] or VLM_ERROR
+        for key, output in zip(keys, outputs)
+    ]
+
+
 def captioning(image: str, model: str) -> str:
     caption = get_vlm_output(image, "Describe this image in detail.", model)
     return caption
@@ -139,6 +241,12 @@ def test_get_vlm_output():
     print(f"{answer=}")
 
 
+def test_get_vlm_outputs():
+    images = ["data/teaser.png", "data/teaser.png"]
+    captions = get_vlm_outputs(images, "Describe this image in detail.", "blip")
+    print(f"{captions=}")
+
+
 def test_get_vlm_output_parallel():
     threads = []
 
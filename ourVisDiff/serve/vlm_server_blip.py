@@ -1,4 +1,9 @@
+import json
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
 
 import torch
 from flask import Flask, jsonify, request
@@ -10,6 +15,9 @@ app = Flask(__name__)
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
+MAX_BATCH_SIZE = 16  # maximum number of images per generate call
+MAX_WAIT_MS = 10  # how long the first request of a batch waits for others
+
 device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
 logging.info("Loading model... This might take a while.")
 model, vis_processors, _ = load_model_and_preprocess(
@@ -17,6 +25,50 @@ model, vis_processors, _ = load_model_and_preprocess(
 )
 logging.info("Model loaded successfully!")
 
+# (preprocessed image, prompt, future) triples waiting for the batch worker
+request_queue = queue.Queue()
+
+
+def batch_worker():
+    """
+    Collect concurrent requests for up to MAX_WAIT_MS and run them through
+    model.generate as one batch. Every request gets its own result back.
+    """
+    while True:
+        batch = [request_queue.get()]
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        images, prompts, futures = zip(*batch)
+        try:
+            with torch.no_grad():
+                image = torch.stack(images).to(device)
+                results = model.generate({"image": image, "prompt": list(prompts)})
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            logging.error(f"Batch Error: {e}")
+            for future in futures:
+                future.set_exception(e)
+
+
+def submit(image_file, prompt: str) -> Future:
+    # decoding and preprocessing run on the request thread, in parallel
+    raw_image = Image.open(image_file).convert("RGB")
+    future = Future()
+    request_queue.put((vis_processors["eval"](raw_image), prompt, future))
+    return future
+
+
+threading.Thread(target=batch_worker, daemon=True).start()
+
 
 @app.route("/", methods=["POST"])
 def interact_with_blip():
@@ -26,14 +78,37 @@ def interact_with_blip():
     if "text" not in request.form:
         return jsonify({"error": "Text not provided"}), 400
 
-    raw_image = Image.open(request.files["image"]).convert("RGB")
-    with torch.no_grad():
-        image = vis_processors["eval"](raw_image).unsqueeze(0).to(device)
-        result = model.generate({"image": image, "prompt": request.form["text"]})[0]
+    result = submit(request.files["image"], request.form["text"]).result()
 
     return jsonify({"input": request.form["text"], "output": result})
 
 
+@app.route("/batch", methods=["POST"])
+def interact_with_blip_batch():
+    """
+    Caption several images in one request. Takes the images as repeated "image"
+    files and either one "text" prompt for all of them or a JSON list "texts".
+    """
+    image_files = request.files.getlist("image")
+    if len(image_files) == 0:
+        return jsonify({"error": "Image not provided"}), 400
+
+    if "texts" in request.form:
+        texts = json.loads(request.form["texts"])
+    elif "text" in request.form:
+        texts = [request.form["text"]] * len(image_files)
+    else:
+        return jsonify({"error": "Text not provided"}), 400
+
+    if len(texts) != len(image_files):
+        return jsonify({"error": "Number of texts and images differ"}), 400
+
+    futures = [submit(image_file, text) for image_file, text in zip(image_files, texts)]
+    results = [future.result() for future in futures]
+
+    return jsonify({"input": texts, "output": results})
+
+
 if __name__ == "__main__":
     logging.info("Server is running!")
-    app.run(host="0.0.0.0", port=8082, debug=False)
+    app.run(host="0.0.0.0", port=8082, debug=False, threaded=True)
@@ -1,5 +1,8 @@
 import json
 import logging
+import os
+import threading
+from collections import OrderedDict
 from typing import Dict, List
 
 import numpy as np
@@ -21,11 +24,53 @@ model, vis_processors, _ = load_model_and_preprocess(
 logging.info("Model loaded successfully!")
 
 
-def get_embed(img_path: str) -> torch.Tensor:
-    raw_image = Image.open(img_path).convert("RGB")
-    device = torch.device("cuda:0")
-    image = vis_processors["eval"](raw_image).unsqueeze(0).to(device)
-    embeds = model.embed_image({"image": image})
+EMBED_BATCH_SIZE = 64  # images per embed_image forward
+EMBED_CACHE_BYTES = int(2e9)  # host memory for cached per-image embeddings
+
+# (path, mtime) -> embed_image output of shape [1, 257, 1408], least recently
+# used first, so overlapping samples of later proposer rounds skip the encoder.
+# Kept in host memory so the cache never competes with the model for the GPU.
+embed_cache = OrderedDict()
+embed_cache_bytes = 0
+embed_cache_lock = threading.Lock()
+
+
+def get_embeds(img_paths: List[str]) -> torch.Tensor:
+    """
+    Stacked embeddings of img_paths on the device, shape [N, 1, 257, 1408].
+    """
+    with embed_cache_lock:
+        embeds = _get_embeds(img_paths)
+    return torch.stack(embeds).to(device)
+
+
+def _get_embeds(img_paths: List[str]) -> List[torch.Tensor]:
+    global embed_cache_bytes
+    keys = [(img_path, os.stat(img_path).st_mtime_ns) for img_path in img_paths]
+    missing = [key for key in dict.fromkeys(keys) if key not in embed_cache]
+
+    for i in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[i : i + EMBED_BATCH_SIZE]
+        images = torch.stack(
+            [
+                vis_processors["eval"](Image.open(img_path).convert("RGB"))
+                for img_path, _ in batch
+            ]
+        ).to(device)
+        with torch.no_grad():
+            embeds = model.embed_image({"image": images}).cpu()
+        for key, embed in zip(batch, embeds.split(1)):
+            embed = embed.clone()  # not a view that keeps the whole batch alive
+            embed_cache[key] = embed
+            embed_cache_bytes += embed.numel() * embed.element_size()
+
+    embeds = []
+    for key in keys:
+        embed_cache.move_to_end(key)
+        embeds.append(embed_cache[key])
+    while embed_cache_bytes > EMBED_CACHE_BYTES and embed_cache:
+        _, embed = embed_cache.popitem(last=False)
+        embed_cache_bytes -= embed.numel() * embed.element_size()
     return embeds
 
 
@@ -38,24 +83,23 @@ def get_embed_caption_blip(
     test_image = random_image.convert("RGB")
     ex_image = vis_processors["eval"](test_image).unsqueeze(0).to(device)
 
-    all_embeds1 = []
-    all_embeds2 = []
+    # both groups are encoded in one pass over the images, pairing them up like
+    # zip(sampled_dataset1, sampled_dataset2) did
+    n = min(len(sampled_dataset1), len(sampled_dataset2))
+    paths1 = [item["path"] for item in sampled_dataset1[:n]]
+    paths2 = [item["path"] for item in sampled_dataset2[:n]]
+    all_embeds = get_embeds(paths1 + paths2)
+    all_embeds1 = all_embeds[: len(paths1)]
+    all_embeds2 = all_embeds[len(paths1) :]
 
-    for image_file1, image_file2 in zip(sampled_dataset1, sampled_dataset2):
-        embeds1 = get_embed(image_file1["path"])
-        all_embeds1.append(embeds1)
-
-        embeds2 = get_embed(image_file2["path"])
-        all_embeds2.append(embeds2)
-
-    mean_embeds1 = torch.mean(torch.stack(all_embeds1), dim=0)
-    mean_embeds2 = torch.mean(torch.stack(all_embeds2), dim=0)
+    mean_embeds1 = torch.mean(all_embeds1, dim=0)
+    mean_embeds2 = torch.mean(all_embeds2, dim=0)
 
     dif_embed = mean_embeds1 - mean_embeds2
-    dif_result = [
-        model.generate({"image": ex_image}, image_embeds=dif_embed)[0]
-        for i in range(10)
-    ]
+    # default decoding is beam search, which is deterministic: the 10 generate
+    # calls this replaces all returned the same caption
+    caption = model.generate({"image": ex_image}, image_embeds=dif_embed)[0]
+    dif_result = [caption] * 10
 
     return dif_result
 
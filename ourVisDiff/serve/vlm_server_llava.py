@@ -1,6 +1,12 @@
+import functools
 import logging
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import Future
 from dataclasses import dataclass
+from typing import List, Tuple
 
 import torch
 from flask import Flask, jsonify, request
@@ -32,6 +38,8 @@ class Args:
     temperature: float = 0.2
     max_new_tokens: int = 512
     image_aspect_ratio: str = "pad"
+    max_batch_size: int = 8  # maximum number of requests per generate call
+    max_wait_ms: int = 20  # how long the first request of a batch waits for others
 
 
 args = Args()
@@ -53,39 +61,35 @@ tokenizer, model, image_processor, context_len = load_pretrained_model(
 logging.info("Model loaded successfully!")
 
 
-@app.route("/", methods=["POST"])
-def interact_with_llava():
-    if "image" not in request.files:
-        return jsonify({"error": "Image not provided"}), 400
+if "llama-2" in model_name.lower():
+    conv_mode = "llava_llama_2"
+elif "v1" in model_name.lower():
+    conv_mode = "llava_v1"
+elif "mpt" in model_name.lower():
+    conv_mode = "mpt"
+else:
+    conv_mode = "llava_v0"
+
+# batched prompts are left-padded so that generation continues right after the
+# last prompt token of every row
+tokenizer.padding_side = "left"
+model.config.tokenizer_padding_side = "left"
+pad_token_id = (
+    tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.unk_token_id
+)
 
-    if "text" not in request.form:
-        return jsonify({"error": "Text not provided"}), 400
+# (PIL image, text, future) triples waiting for the batch worker
+request_queue = queue.Queue()
 
-    if "llama-2" in model_name.lower():
-        conv_mode = "llava_llama_2"
-    elif "v1" in model_name.lower():
-        conv_mode = "llava_v1"
-    elif "mpt" in model_name.lower():
-        conv_mode = "mpt"
-    else:
-        conv_mode = "llava_v0"
 
+@functools.lru_cache(maxsize=1024)
+def build_prompt(text: str) -> Tuple[str, torch.Tensor, str]:
+    """
+    Build the conversation prompt and its token ids for a request text. Rankers
+    send the same question for thousands of images, so this is memoized and the
+    shared system/question prefix is only templated and tokenized once.
+    """
     conv = conv_templates[conv_mode].copy()
-    if "mpt" in model_name.lower():
-        roles = ("user", "assistant")
-    else:
-        roles = conv.roles
-
-    raw_image = Image.open(request.files["image"]).convert("RGB")
-    image_tensor = process_images([raw_image], image_processor, args)
-    if type(image_tensor) is list:
-        image_tensor = [
-            image.to(model.device, dtype=torch.float16) for image in image_tensor
-        ]
-    else:
-        image_tensor = image_tensor.to(model.device, dtype=torch.float16)
-
-    inp = request.form["text"]
 
     if model.config.mm_use_im_start_end:
         inp = (
@@ -93,41 +97,137 @@ def interact_with_llava():
             + DEFAULT_IMAGE_TOKEN
             + DEFAULT_IM_END_TOKEN
             + "\n"
-            + inp
+            + text
         )
     else:
-        inp = DEFAULT_IMAGE_TOKEN + "\n" + inp
+        inp = DEFAULT_IMAGE_TOKEN + "\n" + text
 
     conv.append_message(conv.roles[0], inp)
     conv.append_message(conv.roles[1], None)
     prompt = conv.get_prompt()
 
-    input_ids = (
-        tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt")
-        .unsqueeze(0)
-        .cuda()
+    input_ids = tokenizer_image_token(
+        prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt"
     )
     stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-    keywords = [stop_str]
+    return prompt, input_ids, stop_str
+
+
+def left_pad(sequences: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    max_len = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        input_ids[i, max_len - len(sequence) :] = sequence
+        attention_mask[i, max_len - len(sequence) :] = 1
+    return input_ids, attention_mask
+
+
+def generate_batch(raw_images: List[Image.Image], texts: List[str]) -> List[str]:
+    image_tensor = process_images(raw_images, image_processor, args)
+    if type(image_tensor) is list:
+        image_tensor = [
+            image.to(model.device, dtype=torch.float16) for image in image_tensor
+        ]
+    else:
+        image_tensor = image_tensor.to(model.device, dtype=torch.float16)
+
+    prompts = [build_prompt(text) for text in texts]
+    input_ids, attention_mask = left_pad([input_ids for _, input_ids, _ in prompts])
+    input_ids = input_ids.to(model.device)
+    attention_mask = attention_mask.to(model.device)
+    keywords = list({stop_str for _, _, stop_str in prompts})
     stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
 
     with torch.inference_mode():
         output_ids = model.generate(
             input_ids,
+            attention_mask=attention_mask,
             images=image_tensor,
             do_sample=True,
             temperature=args.temperature,
             max_new_tokens=args.max_new_tokens,
             use_cache=True,
+            pad_token_id=pad_token_id,
             stopping_criteria=[stopping_criteria],
         )
 
-    outputs = tokenizer.decode(output_ids[0, input_ids.shape[1] :]).strip()
-    conv.messages[-1][-1] = outputs
+    return [
+        decode_output(row, stop_str)
+        for row, (_, _, stop_str) in zip(output_ids[:, input_ids.shape[1] :], prompts)
+    ]
+
+
+def decode_output(output_ids: torch.Tensor, stop_str: str) -> str:
+    """
+    Decode one row of a batch the way the single-request server did, keeping
+    special tokens such as </s>. The batch only stops once every row produced a
+    stop string, so a row is cut right after its first stop string and the
+    padding generate() appends after </s> is dropped.
+    """
+    ids = output_ids.tolist()
+    if tokenizer.eos_token_id in ids:
+        ids = ids[: ids.index(tokenizer.eos_token_id) + 1]
+    output = tokenizer.decode(ids)
+    if stop_str in output:
+        output = output[: output.index(stop_str) + len(stop_str)]
+    return output.strip()
+
+
+def batch_worker():
+    """
+    Collect concurrent requests for up to args.max_wait_ms and generate their
+    answers as one left-padded batch, logging the throughput of every batch.
+    """
+    while True:
+        batch = [request_queue.get()]
+        deadline = time.monotonic() + args.max_wait_ms / 1000
+        while len(batch) < args.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        raw_images, texts, futures = zip(*batch)
+        start = time.time()
+        try:
+            results = generate_batch(list(raw_images), list(texts))
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            logging.error(f"Batch Error: {e}")
+            for future in futures:
+                future.set_exception(e)
+            continue
+        elapsed = time.time() - start
+        logging.info(
+            f"Batch of {len(batch)} in {elapsed:.2f}s ({len(batch) / elapsed:.2f} images/s)"
+        )
+
+
+threading.Thread(target=batch_worker, daemon=True).start()
+
+
+@app.route("/", methods=["POST"])
+def interact_with_llava():
+    if "image" not in request.files:
+        return jsonify({"error": "Image not provided"}), 400
+
+    if "text" not in request.form:
+        return jsonify({"error": "Text not provided"}), 400
+
+    raw_image = Image.open(request.files["image"]).convert("RGB")
+    future = Future()
+    request_queue.put((raw_image, request.form["text"], future))
+    outputs = future.result()
+    prompt, _, _ = build_prompt(request.form["text"])
 
     return jsonify({"input": prompt, "output": outputs})
 
 
 if __name__ == "__main__":
     logging.info("Server is running!")
-    app.run(host="0.0.0.0", port=8084, debug=False)
+    app.run(host="0.0.0.0", port=8084, debug=False, threaded=True)
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List
 import os
 import numpy as np
 
@@ -9,6 +9,7 @@ from omegaconf import OmegaConf
 from tqdm import tqdm
 
 import wandb
+from components.dataset import load_data
 from components.evaluator import GPTEvaluator, NullEvaluator
 from components.proposer import (
     LLMProposer,
@@ -37,30 +38,6 @@ def load_config(config: str) -> Dict:
     return args
 
 
-def load_data(args: Dict) -> Tuple[List[Dict], List[Dict], List[str]]:
-    data_args = args["data"]
-    df = pd.read_csv(f"{data_args['root']}/{data_args['name']}.csv", sep=";")
-
-    if data_args["subset"]:
-        old_len = len(df)
-        df = df[df["subset"] == data_args["subset"]]
-        print(
-            f"Taking {data_args['subset']} subset (dataset size reduced from {old_len} to {len(df)})"
-        )
-    print(f"Group name {df['group_name'].unique()}")
-    dataset1 = df[df["group_name"] == data_args["group1"]].to_dict("records")
-    dataset2 = df[df["group_name"] == data_args["group2"]].to_dict("records")
-    group_names = [data_args["group1"], data_args["group2"]]
-
-    if data_args["purity"] < 1:
-        logging.warning(f"Purity is set to {data_args['purity']}. Swapping groups.")
-        assert len(dataset1) == len(dataset2), "Groups must be of equal size"
-        n_swap = int((1 - data_args["purity"]) * len(dataset1))
-        dataset1 = dataset1[n_swap:] + dataset2[:n_swap]
-        dataset2 = dataset2[n_swap:] + dataset1[:n_swap]
-    return dataset1, dataset2, group_names
-
-
 def caption(args: Dict, dataset1: List[Dict], dataset2: List[Dict]) -> List[str]:
     captioner_args = args["proposer"]
     captioner_args["seed"] = args["seed"]